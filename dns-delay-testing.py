@@ -1,9 +1,39 @@
 import argparse
+import asyncio
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import queue
+import random
+import struct
+import threading
 import time
 from datetime import datetime
+import dns.message
+import dns.rcode
+import dns.rdatatype
 import dns.resolver
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+except ImportError:  # 只有doh传输方式需要：pip install h2
+    h2 = None
 import socket
+import sqlite3
+import ssl
+import sys
 import traceback
+import unicodedata
+from array import array
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlsplit
+from contextlib import closing, contextmanager
 
 def test_port_connectivity(ip, port, timeout=2):
     """测试指定IP和端口的连接性"""
@@ -18,52 +48,313 @@ def test_port_connectivity(ip, port, timeout=2):
         print(f"  端口连接测试异常: {str(e)}")
         return False
 
-def test_dns_latency(dns_server, domain, timeout=5, retries=1):
-    """测试单次DNS解析延迟"""
-    resolver = dns.resolver.Resolver()
-    
-    # 解析DNS服务器地址和端口
-    ip = None
-    port = 53  # 默认DNS端口
-    
+DEFAULT_ENDPOINT_TTL = 300  # 无法获得应答TTL时，服务器地址的缓存时间（秒）
+ENDPOINT_RETRY_INTERVAL = 30  # 重新解析失败时，沿用旧地址的时间（秒）
+MIN_ENDPOINT_TTL = 30  # 服务器地址最短的缓存时间（秒），TTL为0时也不在每次测试前重新解析
+ENDPOINT_TTL_LOOKUP_TIMEOUT = 2  # 查询服务器地址TTL的超时时间上限（秒）
+
+def split_dns_server(dns_server, default_port=53):
+    """拆分DNS服务器参数，返回(主机, 端口)，未指定端口时使用default_port"""
     if ':' in dns_server:
         server_part, port_part = dns_server.split(':', 1)
-        port = int(port_part)
-    else:
-        server_part = dns_server
-    
-    # 尝试将server_part解析为IP地址
-    try:
-        # 方法1：使用socket库进行域名解析
-        ip = socket.gethostbyname(server_part)
-    except socket.gaierror:
+        return server_part, int(port_part)
+    return dns_server, default_port
+
+class ServerEndpoint:
+    """DNS服务器端点缓存：每次运行解析一次地址，按应答TTL过期后重新解析"""
+
+    def __init__(self, dns_server, timeout=5, default_port=53):
+        if '://' in dns_server:
+            # DoH服务器可以直接使用URL，如 https://dns.google/dns-query
+            url = urlsplit(dns_server)
+            self.host, self.port = url.hostname, url.port or default_port
+            self.path = url.path or '/dns-query'
+        else:
+            self.host, self.port = split_dns_server(dns_server, default_port)
+            self.path = '/dns-query'
+
+        self.timeout = timeout
+        self.ips = []
+        self.expires_at = 0.0
+        self._refreshing = None
+        self.refresh()
+
+    @property
+    def ip(self):
+        """当前使用的服务器IP，缓存过期时自动重新解析"""
+        if time.monotonic() >= self.expires_at:
+            self.refresh()
+        return self.ips[0]
+
+    async def resolve(self):
+        """事件循环中使用的ip：缓存过期时在线程池中重新解析，不阻塞事件循环，并发调用共享同一次解析"""
+        if time.monotonic() >= self.expires_at:
+            if self._refreshing is None:
+                self._refreshing = asyncio.get_running_loop().run_in_executor(None, self.refresh)
+            refreshing = self._refreshing
+            try:
+                await asyncio.shield(refreshing)
+            finally:
+                if refreshing.done() and self._refreshing is refreshing:
+                    self._refreshing = None
+        return self.ips[0]
+
+    def refresh(self):
+        """解析服务器地址并根据TTL设置过期时间"""
+        try:
+            socket.inet_pton(socket.AF_INET, self.host)
+            # 已经是IP地址，无需解析，永不过期
+            self.ips = [self.host]
+            self.expires_at = float('inf')
+            return
+        except OSError:
+            pass
+
+        try:
+            # 方法1：使用socket库进行域名解析（支持hosts文件），与系统中其他程序得到的地址一致
+            _, _, ips = socket.gethostbyname_ex(self.host)
+        except OSError:
+            if self.ips:
+                # 解析失败时暂时沿用上一次的地址
+                self.expires_at = time.monotonic() + ENDPOINT_RETRY_INTERVAL
+            else:
+                # 如果无法解析，则假设host已经是IP地址
+                self.ips = [self.host]
+                self.expires_at = float('inf')
+            return
+        self.ips = ips
+        # TTL过短时也至少缓存MIN_ENDPOINT_TTL秒，避免测试循环中反复解析
+        self.expires_at = time.monotonic() + max(self._lookup_ttl(ips), MIN_ENDPOINT_TTL)
+
+    def _lookup_ttl(self, ips):
+        """方法2：使用dnspython查询同一域名，只用于获得应答TTL；地址来自hosts文件等
+        其他来源（应答中没有这些地址）或查询失败时使用默认值"""
         try:
-            # 方法2：使用系统默认DNS解析器解析DNS服务器域名
             system_resolver = dns.resolver.Resolver()
-            system_resolver.timeout = timeout
-            system_resolver.lifetime = timeout
-            answers = system_resolver.resolve(server_part, 'A')
-            ip = str(answers[0])
+            system_resolver.timeout = system_resolver.lifetime = min(self.timeout, ENDPOINT_TTL_LOOKUP_TIMEOUT)
+            answers = system_resolver.resolve(self.host, 'A')
         except Exception:
-            # 如果两种方法都无法解析，则假设server_part已经是IP地址
-            ip = server_part
-    
-    # 测试端口连接性
-    port_open = test_port_connectivity(ip, port)
-    print(f"  服务器IP: {ip}, 端口: {port}, 端口连接状态: {'开放' if port_open else '关闭或无法连接'}")
-    
+            return DEFAULT_ENDPOINT_TTL
+        if not set(ips) & {str(rdata) for rdata in answers}:
+            return DEFAULT_ENDPOINT_TTL
+        return answers.rrset.ttl
+
+def _configure_resolver(resolver, ip, port, timeout):
+    """把Resolver配置为只向指定服务器查询"""
     resolver.nameservers = [ip]
     resolver.port = port
     resolver.timeout = timeout  # 超时时间（秒）
     resolver.lifetime = timeout  # 总生命周期（秒）
-    
-    try:
+    return resolver
+
+class ResolverPool:
+    """按(ip, port, timeout)缓存预先配置好的Resolver，避免每次测试重新读取resolv.conf；
+    每个线程缓存自己的Resolver，threads引擎下各线程借用时无需加锁"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @contextmanager
+    def borrow(self, ip, port, timeout):
+        """借出当前线程缓存的Resolver，首次使用时创建"""
+        resolvers = getattr(self._local, 'resolvers', None)
+        if resolvers is None:
+            resolvers = self._local.resolvers = {}
+        key = (ip, port, timeout)
+        resolver = resolvers.get(key)
+        if resolver is None:
+            resolver = resolvers[key] = _configure_resolver(
+                dns.resolver.Resolver(configure=False), ip, port, timeout)
+        yield resolver
+
+RESOLVER_POOL = ResolverPool()
+
+def measure_setup_cost(endpoint, timeout, rounds=1000):
+    """对比每次新建Resolver与从池中借用Resolver的单次准备开销（微秒）"""
+    ip, port = endpoint.ip, endpoint.port
+
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        _configure_resolver(dns.resolver.Resolver(), ip, port, timeout)
+    fresh_cost = (time.perf_counter() - start_time) / rounds * 1e6
+
+    pool = ResolverPool()
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        with pool.borrow(ip, port, timeout):
+            pass
+    pooled_cost = (time.perf_counter() - start_time) / rounds * 1e6
+    return fresh_cost, pooled_cost
+
+class EndpointHealth:
+    """端口连接性缓存：启动时探测一次，之后在后台线程中按固定间隔刷新"""
+
+    def __init__(self, endpoint, interval=30):
+        self.endpoint = endpoint
+        self.interval = interval
+        self.port_open = test_port_connectivity(endpoint.ip, endpoint.port)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """启动后台刷新线程，interval不大于0时不刷新"""
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.port_open = test_port_connectivity(self.endpoint.ip, self.endpoint.port)
+
+class PhaseTimer:
+    """分阶段打点计时：每次mark用perf_counter_ns记录距上一次打点的耗时（纳秒）"""
+
+    def __init__(self, phase_stats):
+        self.phase_stats = phase_stats  # 阶段名 -> LatencyHistogram
+        self.last = time.perf_counter_ns()
+
+    def mark(self, phase):
+        now = time.perf_counter_ns()
+        self.phase_stats[phase].record(now - self.last)
+        self.last = now
+
+
+class QueryFailure(str):
+    """失败的测试结果：文字为"错误类型: 说明"，同时以属性携带错误类型和服务器返回的响应码
+    （响应码文字，没有收到响应时为None），输出样本时不需要再解析文字"""
+
+    def __new__(cls, error_class, detail, rcode=None):
+        failure = super().__new__(cls, f"{error_class}: {detail}")
+        failure.error_class = error_class
+        failure.rcode = rcode
+        return failure
+
+
+class DNSResponseError(Exception):
+    """服务器返回了错误响应码或没有应答记录，参数为QueryFailure"""
+
+
+def _exception_rcode(e):
+    """取出查询异常对应的服务器响应码（文字），没有收到响应时返回None"""
+    if isinstance(e, DNSResponseError):
+        return e.args[0].rcode
+    if isinstance(e, dns.resolver.NXDOMAIN):
+        return 'NXDOMAIN'
+    if isinstance(e, dns.resolver.YXDOMAIN):
+        return 'YXDOMAIN'
+    if isinstance(e, dns.resolver.NoAnswer):
+        return 'NOERROR'
+    if isinstance(e, dns.resolver.NoNameservers):
+        # SERVFAIL、REFUSED等响应码由Resolver包装为NoNameservers，
+        # errors中每项为(服务器, 是否TCP, 端口, 错误, 响应报文)，取最后一次收到的响应
+        for error in reversed(e.kwargs.get('errors') or []):
+            if isinstance(error[-1], dns.message.Message):
+                return dns.rcode.to_text(error[-1].rcode())
+    return None
+
+
+def _instrumented_udp_query(endpoint, domain, rdtype, timeout, phase_stats):
+    """逐阶段计时的UDP查询，返回总延迟（毫秒）"""
+    timer = PhaseTimer(phase_stats)
+    start_ns = timer.last
+    ip, port = endpoint.ip, endpoint.port
+    timer.mark('地址解析')
+    query = dns.message.make_query(domain, rdtype)
+    wire = query.to_wire()
+    timer.mark('报文构建')
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect((ip, port))
+        timer.mark('套接字连接')
+        sock.send(wire)
+        timer.mark('发送')
+        deadline = time.monotonic() + timeout
+        while True:
+            data = sock.recv(65535)
+            if data[:2] == wire[:2]:
+                break
+            # 丢弃事务ID不匹配的迟到响应
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+        timer.mark('首字节')
+    response = dns.message.from_wire(data)
+    success, result = _evaluate_response(response, 0, 0)
+    timer.mark('解析')
+    if not success:
+        raise DNSResponseError(result)
+    return (timer.last - start_ns) / 1e6
+
+
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)  # Linux常量，socket模块未导出时使用内核头文件中的值
+_TIMESPEC = struct.Struct('@qq')
+
+def _kernel_timestamped_udp_query(endpoint, domain, rdtype, timeout):
+    """使用SO_TIMESTAMPNS取内核接收时间戳的UDP查询，返回(用户态延迟, 内核时间戳延迟)（毫秒）"""
+    wire = get_query_template(domain, rdtype).render(random.getrandbits(16))
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        sock.settimeout(timeout)
+        sock.connect((endpoint.ip, endpoint.port))
+        # 内核时间戳基于CLOCK_REALTIME，发送时间也取同一时钟
+        send_ns = time.time_ns()
+        sock.send(wire)
+        deadline = time.monotonic() + timeout
+        while True:
+            data, ancdata, _, _ = sock.recvmsg(65535, socket.CMSG_SPACE(_TIMESPEC.size))
+            receive_ns = time.time_ns()
+            if data[:2] == wire[:2]:
+                break
+            # 丢弃事务ID不匹配的迟到响应
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+
+    kernel_ns = None
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(cmsg_data) >= _TIMESPEC.size:
+            seconds, nanoseconds = _TIMESPEC.unpack_from(cmsg_data)
+            kernel_ns = seconds * 10**9 + nanoseconds
+    if kernel_ns is None:
+        raise OSError("内核没有返回接收时间戳（SO_TIMESTAMPNS不受支持）")
+
+    success, result = _evaluate_response(dns.message.from_wire(data), 0, 0)
+    if not success:
+        raise DNSResponseError(result)
+    return (receive_ns - send_ns) / 1e6, (kernel_ns - send_ns) / 1e6
+
+
+def _resolver_query(ip, port, domain, rdtype, timeout):
+    """用Resolver池中的解析器执行一次被测量的查询，返回延迟（毫秒）"""
+    with RESOLVER_POOL.borrow(ip, port, timeout) as resolver:
         start_time = time.perf_counter()
-        # 执行A记录查询 - 使用推荐的resolve方法替代query
-        resolver.resolve(domain, 'A')
+        # 执行查询（默认A记录） - 使用推荐的resolve方法替代query
+        resolver.resolve(domain, rdtype)
         end_time = time.perf_counter()
-        latency = (end_time - start_time) * 1000  # 转换为毫秒
-        return True, latency
+    return (end_time - start_time) * 1000  # 转换为毫秒
+
+
+def test_dns_latency(dns_server, domain, timeout=5, retries=1, endpoint=None, health=None, rdtype='A',
+                     phase_stats=None, kernel_stats=None, log=print):
+    """测试单次DNS解析延迟，endpoint为预先解析好的ServerEndpoint，health为端口连接性缓存，
+    指定phase_stats时逐阶段计时并记录到其中，指定kernel_stats时额外记录基于内核接收时间戳的延迟，
+    log用于输出服务器信息（多线程时先收集再整行输出）"""
+    if endpoint is None:
+        endpoint = ServerEndpoint(dns_server, timeout)
+    ip, port = endpoint.ip, endpoint.port
+    
+    # 端口连接性只用于诊断，优先使用缓存结果，避免在测量循环中额外发起TCP连接
+    port_open = health.port_open if health is not None else test_port_connectivity(ip, port)
+    log(f"  服务器IP: {ip}, 端口: {port}, 端口连接状态: {'开放' if port_open else '关闭或无法连接'}")
+    
+    try:
+        if phase_stats is not None:
+            return True, _instrumented_udp_query(endpoint, domain, rdtype, timeout, phase_stats)
+        if kernel_stats is not None:
+            latency, kernel_latency = _kernel_timestamped_udp_query(endpoint, domain, rdtype, timeout)
+            kernel_stats.record(True, kernel_latency)
+            return True, latency
+        return True, _resolver_query(ip, port, domain, rdtype, timeout)
     except Exception as e:
         # 捕获所有可能的异常（超时、解析失败等）
         error_type = type(e).__name__
@@ -84,10 +375,2067 @@ def test_dns_latency(dns_server, domain, timeout=5, retries=1):
             additional_info.append("服务器拒绝连接、访问权限问题")
         
         # 显示完整的错误信息和可能原因
-        full_error = f"{error_type}: {error_msg}\n可能原因: " + ", ".join(additional_info)
+        full_error = QueryFailure(error_type, f"{error_msg}\n可能原因: " + ", ".join(additional_info),
+                                  _exception_rcode(e))
         return False, full_error
 
+class QueryTemplate:
+    """预编码的DNS查询报文：报文只编码一次，发送时仅原地修改16位事务ID"""
+
+    __slots__ = ('buffer', 'view')
+
+    def __init__(self, domain, rdtype='A', use_edns=-1, payload=None):
+        query = dns.message.make_query(domain, rdtype, use_edns=use_edns, payload=payload)
+        self.buffer = bytearray(query.to_wire())
+        self.view = memoryview(self.buffer)
+
+    def render(self, query_id):
+        """写入事务ID并返回报文视图（下次render前有效）"""
+        struct.pack_into('!H', self.buffer, 0, query_id)
+        return self.view
+
+_QUERY_TEMPLATES = {}
+QUERY_TEMPLATE_CACHE_SIZE = 65536  # 域名列表很大时只保留最近创建的模板
+
+def get_query_template(domain, rdtype='A', use_edns=-1, payload=None):
+    """按(域名, 记录类型, EDNS选项)缓存查询模板"""
+    key = (domain, rdtype, use_edns, payload)
+    template = _QUERY_TEMPLATES.get(key)
+    if template is None:
+        if len(_QUERY_TEMPLATES) >= QUERY_TEMPLATE_CACHE_SIZE:
+            del _QUERY_TEMPLATES[next(iter(_QUERY_TEMPLATES))]
+        template = _QUERY_TEMPLATES[key] = QueryTemplate(domain, rdtype, use_edns, payload)
+    return template
+
+
+MAX_PENDING_QUERIES = 32768  # 每个套接字或连接上同时在途的查询数上限，留出一半空闲事务ID使随机分配很快成功
+
+
+class QueryIDExhausted(Exception):
+    """套接字或连接上在途查询过多，没有空闲的事务ID"""
+
+
+class _PendingQueries:
+    """按事务ID把响应分发给等待中的请求"""
+
+    def __init__(self):
+        self.pending = {}  # 事务ID -> Future
+
+    def dispatch(self, data):
+        if len(data) < 2:
+            return
+        future = self.pending.pop(int.from_bytes(data[:2], 'big'), None)
+        if future is not None and not future.done():
+            future.set_result((data, time.perf_counter()))
+
+    def fail_all(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.pending.clear()
+
+    def has_capacity(self):
+        return len(self.pending) < MAX_PENDING_QUERIES
+
+    def new_query_id(self):
+        """分配一个当前未被占用的事务ID，在途查询已达上限时抛出QueryIDExhausted"""
+        if not self.has_capacity():
+            raise QueryIDExhausted(f"在途查询已达{MAX_PENDING_QUERIES}个，没有空闲的事务ID")
+        while True:
+            query_id = random.getrandbits(16)
+            if query_id not in self.pending:
+                return query_id
+
+
+class _UDPQueryProtocol(_PendingQueries, asyncio.DatagramProtocol):
+    """非阻塞UDP查询协议"""
+
+    def datagram_received(self, data, addr):
+        self.dispatch(data)
+
+    def error_received(self, exc):
+        # ICMP不可达等错误无法对应到具体请求，全部按失败处理
+        self.fail_all(exc)
+
+
+async def _exchange(dispatcher, send, domain, timeout, rdtype='A', timing=None):
+    """发送一次查询并等待dispatcher分发回来的响应，send负责把报文写到网络；
+    指定timing时在其中记录实际发送时间'sent'和收到响应的时间'received'（perf_counter）"""
+    loop = asyncio.get_running_loop()
+    template = get_query_template(domain, rdtype)
+    try:
+        query_id = dispatcher.new_query_id()
+    except QueryIDExhausted as e:
+        # 立即失败，不等待事务ID释放，避免阻塞事件循环
+        return False, QueryFailure('QueryIDExhausted', e)
+    future = loop.create_future()
+    dispatcher.pending[query_id] = future
+    try:
+        start_time = time.perf_counter()
+        # send会立即发送或复制待发数据，模板缓冲区可以马上复用
+        send(template.render(query_id))
+        if timing is not None:
+            timing['sent'] = start_time
+        data, end_time = await asyncio.wait_for(future, timeout)
+        if timing is not None:
+            timing['received'] = end_time
+        response = dns.message.from_wire(data)
+    except asyncio.TimeoutError:
+        return False, QueryFailure('Timeout', f"DNS查询在{timeout}秒内未收到响应")
+    except Exception as e:
+        return False, QueryFailure(type(e).__name__, e)
+    finally:
+        dispatcher.pending.pop(query_id, None)
+
+    return _evaluate_response(response, start_time, end_time)
+
+
+def _evaluate_response(response, start_time, end_time):
+    """根据响应码和应答判断查询是否成功，成功时返回延迟（毫秒）"""
+    rcode = response.rcode()
+    if rcode != dns.rcode.NOERROR:
+        rcode_text = dns.rcode.to_text(rcode)
+        return False, QueryFailure(rcode_text, "服务器返回错误响应码", rcode_text)
+    if not response.answer:
+        return False, QueryFailure('NoAnswer', "响应中没有应答记录", 'NOERROR')
+    return True, (end_time - start_time) * 1000  # 转换为毫秒
+
+
+MAX_UDP_SOCKETS = 16  # 每个UDP通道最多使用的套接字数
+ENDPOINT_CHECK_INTERVAL = 1.0  # UDP通道检查服务器地址是否变化的间隔（秒）
+
+
+class UDPChannel:
+    """UDP查询通道：connections个非阻塞UDP套接字轮流发送，多个查询同时在途；
+    所有套接字的在途查询都达到上限时再打开新的套接字，分摊16位事务ID空间；
+    服务器地址按TTL过期并解析到新地址后，后续查询切换到连接新地址的套接字"""
+
+    default_port = 53
+
+    def __init__(self, target, connections=1, **options):
+        self.endpoint = target.endpoint
+        self.transport_info = target.transport_info
+        self.initial_sockets = min(connections, MAX_UDP_SOCKETS)
+        self.address = None
+        self.sockets = []  # [(transport, protocol)]
+        self.retired = []  # 地址变化前的套接字，等待在途查询超时后关闭
+        self.next_socket = 0
+        self._open_lock = None
+        self._watch_task = None
+
+    async def _open_socket(self):
+        loop = asyncio.get_running_loop()
+        return await loop.create_datagram_endpoint(
+            _UDPQueryProtocol, remote_addr=(self.address, self.endpoint.port))
+
+    async def _open_sockets(self):
+        sockets = []
+        try:
+            for _ in range(self.initial_sockets):
+                sockets.append(await self._open_socket())
+        except Exception:
+            for transport, _ in sockets:
+                transport.close()
+            raise
+        return sockets
+
+    async def open(self, timeout=5):
+        self._open_lock = asyncio.Lock()
+        self.address = await self.endpoint.resolve()
+        self.sockets = await self._open_sockets()
+        self._watch_task = asyncio.ensure_future(self._watch_address(timeout))
+        return self
+
+    async def _watch_address(self, timeout):
+        """定期检查服务器地址，地址变化后打开连接新地址的套接字，旧套接字在在途查询超时后关闭"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(ENDPOINT_CHECK_INTERVAL)
+            address = await self.endpoint.resolve()
+            if address == self.address:
+                continue
+            previous_address, self.address = self.address, address
+            try:
+                sockets = await self._open_sockets()
+            except OSError:
+                self.address = previous_address  # 下次检查时重试
+                continue
+            retired, self.sockets = self.sockets, sockets
+            self.retired.extend(retired)
+            loop.call_later(timeout, self._close_retired, retired)
+            self.transport_info['服务器地址切换'] = self.transport_info.get('服务器地址切换', 0) + 1
+
+    def _close_retired(self, retired):
+        for socket_pair in retired:
+            socket_pair[0].close()
+            self.retired.remove(socket_pair)
+
+    async def _socket(self):
+        """轮流返回还有空闲事务ID的套接字，都已占满且未达套接字上限时打开新的套接字"""
+        count = len(self.sockets)
+        for offset in range(count):
+            index = (self.next_socket + offset) % count
+            if self.sockets[index][1].has_capacity():
+                self.next_socket = index + 1
+                return self.sockets[index]
+        async with self._open_lock:
+            if not self.sockets[-1][1].has_capacity() and len(self.sockets) < MAX_UDP_SOCKETS:
+                self.sockets.append(await self._open_socket())
+        # 达到套接字上限时交给_exchange立即失败
+        return self.sockets[-1]
+
+    async def query(self, domain, timeout, rdtype='A', timing=None):
+        try:
+            transport, protocol = await self._socket()
+        except OSError as e:
+            return False, QueryFailure(type(e).__name__, e)
+        return await _exchange(protocol, transport.sendto, domain, timeout, rdtype, timing)
+
+    def close(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+        for transport, _ in self.sockets + self.retired:
+            transport.close()
+
+
+class _StreamConnection(_PendingQueries):
+    """一条长连接：查询带两字节长度前缀，在同一连接上流水线发送（RFC 7766）"""
+
+    def __init__(self, reader, writer):
+        super().__init__()
+        self.writer = writer
+        self.closed = False
+        self._reader_task = asyncio.ensure_future(self._read_loop(reader))
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                length = int.from_bytes(await reader.readexactly(2), 'big')
+                self.dispatch(await reader.readexactly(length))
+        except Exception as e:
+            self.closed = True
+            self.fail_all(ConnectionError(f"连接已关闭: {type(e).__name__}: {e}"))
+
+    def send(self, wire):
+        # 拼接成新的bytes对象，写缓冲区不会引用可复用的模板缓冲区
+        self.writer.write(struct.pack('!H', len(wire)) + wire)
+
+    def close(self):
+        self.closed = True
+        self._reader_task.cancel()
+        self.writer.close()
+
+
+class TCPChannel:
+    """TCP查询通道：维护多条长连接，查询轮流分配到各连接上流水线发送，断开后自动重连"""
+
+    default_port = 53
+    connection_class = _StreamConnection
+
+    def __init__(self, target, connections=1, **options):
+        self.endpoint = target.endpoint
+        self.setup_stats = target.setup_stats  # 建连阶段 -> LatencyHistogram，建连耗时与查询延迟分开统计
+        self.connections = [None] * connections
+        self.locks = [asyncio.Lock() for _ in range(connections)]
+        self.next_slot = 0
+
+    async def open(self, timeout=5):
+        """预先建立所有连接；失败的连接留到查询时重试，失败计入查询结果"""
+        for slot in range(len(self.connections)):
+            try:
+                await self._connection(slot, timeout)
+            except (OSError, asyncio.TimeoutError):
+                pass
+        return self
+
+    async def _connect(self, timeout):
+        """建立一条连接，返回(reader, writer)并记录各阶段耗时"""
+        # 地址缓存过期时在线程池中重新解析，解析时间不计入连接耗时
+        address = await self.endpoint.resolve()
+        start_time = time.perf_counter()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(address, self.endpoint.port), timeout)
+        self.setup_stats['TCP连接'].record_ms((time.perf_counter() - start_time) * 1000)
+        return reader, writer
+
+    async def _connection(self, slot, timeout):
+        async with self.locks[slot]:
+            connection = self.connections[slot]
+            if connection is None or connection.closed:
+                if connection is not None:
+                    connection.close()
+                connection = self.connections[slot] = self.connection_class(*await self._connect(timeout))
+            return connection
+
+    async def query(self, domain, timeout, rdtype='A', timing=None):
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % len(self.connections)
+        try:
+            connection = await self._connection(slot, timeout)
+        except asyncio.TimeoutError:
+            return False, QueryFailure('Timeout', f"建立连接在{timeout}秒内未完成")
+        except OSError as e:
+            return False, QueryFailure(type(e).__name__, f"建立连接失败: {e}")
+        return await self._query_on(connection, domain, timeout, rdtype, timing)
+
+    async def _query_on(self, connection, domain, timeout, rdtype, timing=None):
+        return await _exchange(connection, connection.send, domain, timeout, rdtype, timing)
+
+    def close(self):
+        for connection in self.connections:
+            if connection is not None:
+                connection.close()
+
+class _ResumableSSLContext(ssl.SSLContext):
+    """asyncio建立TLS连接时自动带上保存的会话，实现会话票据恢复"""
+
+    tls_session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname,
+                                session or self.tls_session)
+
+
+def create_tls_context(ca_file=None, insecure=False):
+    """创建DoT使用的TLS上下文：ca_file用于信任自签名证书，insecure跳过证书校验"""
+    context = _ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if insecure:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif ca_file:
+        context.load_verify_locations(ca_file)
+    else:
+        context.load_default_certs()
+    return context
+
+
+class DoTChannel(TCPChannel):
+    """DNS-over-TLS查询通道：复用TLS长连接并支持会话恢复，TCP连接与TLS握手分开计时"""
+
+    default_port = 853
+
+    def __init__(self, target, connections=1, tls_ca=None, tls_insecure=False, tls_hostname=None, **options):
+        super().__init__(target, connections)
+        self.ssl_context = create_tls_context(tls_ca, tls_insecure)
+        self.server_hostname = tls_hostname or self.endpoint.host
+
+    def _save_session(self):
+        """从已有连接中取出带会话票据的TLS会话，供新连接恢复"""
+        for connection in self.connections:
+            if connection is not None and not connection.closed:
+                ssl_object = connection.writer.get_extra_info('ssl_object')
+                if ssl_object is not None and ssl_object.session is not None and ssl_object.session.has_ticket:
+                    self.ssl_context.tls_session = ssl_object.session
+                    return
+
+    async def _connect(self, timeout):
+        loop = asyncio.get_running_loop()
+        self._save_session()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            address = await self.endpoint.resolve()
+            start_time = time.perf_counter()
+            await asyncio.wait_for(loop.sock_connect(sock, (address, self.endpoint.port)), timeout)
+            connected_time = time.perf_counter()
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                sock=sock, ssl=self.ssl_context, server_hostname=self.server_hostname), timeout)
+        except BaseException:
+            sock.close()
+            raise
+        end_time = time.perf_counter()
+
+        session_reused = writer.get_extra_info('ssl_object').session_reused
+        self.setup_stats['TCP连接'].record_ms((connected_time - start_time) * 1000)
+        self.setup_stats['TLS握手（会话恢复）' if session_reused else 'TLS握手（完整）'].record_ms(
+            (end_time - connected_time) * 1000)
+        return reader, writer
+
+class _H2Connection:
+    """一条HTTP/2连接：每个查询占用一个流，多个流在同一连接上并发（RFC 8484）"""
+
+    def __init__(self, reader, writer):
+        self.writer = writer
+        self.closed = False
+        self.h2 = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=True, header_encoding='utf-8'))
+        self.h2.initiate_connection()
+        self.streams = {}  # 流ID -> [Future, 状态码, 响应数据]
+        self.stream_freed = asyncio.Event()
+        self.settings_received = asyncio.Event()
+        self.peak_streams = 0
+        writer.write(self.h2.data_to_send())
+        self._reader_task = asyncio.ensure_future(self._read_loop(reader))
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    raise ConnectionError("服务器关闭了连接")
+                for event in self.h2.receive_data(data):
+                    self._handle_event(event)
+                self.writer.write(self.h2.data_to_send())
+        except Exception as e:
+            self.closed = True
+            for future, _, _ in self.streams.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"连接已关闭: {type(e).__name__}: {e}"))
+            self.streams.clear()
+            self.stream_freed.set()
+            self.settings_received.set()
+
+    def _handle_event(self, event):
+        if isinstance(event, h2.events.ConnectionTerminated):
+            raise ConnectionError(f"服务器发送GOAWAY，错误码: {event.error_code}")
+        if isinstance(event, h2.events.RemoteSettingsChanged):
+            self.settings_received.set()
+            self.stream_freed.set()
+        stream = self.streams.get(getattr(event, 'stream_id', None))
+        if isinstance(event, h2.events.DataReceived):
+            self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            if stream is not None:
+                stream[2].extend(event.data)
+        elif stream is None:
+            return
+        elif isinstance(event, h2.events.ResponseReceived):
+            stream[1] = dict(event.headers).get(':status')
+        elif isinstance(event, h2.events.StreamEnded):
+            self._finish(event.stream_id).set_result((stream[1], bytes(stream[2]), time.perf_counter()))
+        elif isinstance(event, h2.events.StreamReset):
+            self._finish(event.stream_id).set_exception(ConnectionError(f"流被重置，错误码: {event.error_code}"))
+
+    def _finish(self, stream_id):
+        future = self.streams.pop(stream_id)[0]
+        self.stream_freed.set()
+        return future
+
+    def has_stream_slot(self):
+        """是否可以新建流：已收到服务器的SETTINGS，且并发流数量低于服务器允许的上限"""
+        if self.closed:
+            raise ConnectionError("连接已关闭")
+        return (self.settings_received.is_set()
+                and len(self.streams) < self.h2.remote_settings.max_concurrent_streams)
+
+    async def wait_for_stream_change(self):
+        """等待SETTINGS到达或有流结束"""
+        self.stream_freed.clear()
+        await self.stream_freed.wait()
+
+    def send_request(self, wire, path, authority):
+        """在新流上发送一个POST请求，返回(流ID, Future)"""
+        stream_id = self.h2.get_next_available_stream_id()
+        self.h2.send_headers(stream_id, [
+            (':method', 'POST'), (':scheme', 'https'), (':authority', authority), (':path', path),
+            ('content-type', 'application/dns-message'), ('accept', 'application/dns-message'),
+            ('content-length', str(len(wire))),
+        ])
+        self.h2.send_data(stream_id, wire, end_stream=True)
+        self.writer.write(self.h2.data_to_send())
+        future = asyncio.get_running_loop().create_future()
+        self.streams[stream_id] = [future, None, bytearray()]
+        self.peak_streams = max(self.peak_streams, len(self.streams))
+        return stream_id, future
+
+    def cancel_request(self, stream_id):
+        if self.streams.pop(stream_id, None) is not None and not self.closed:
+            self.h2.reset_stream(stream_id, h2.errors.ErrorCodes.CANCEL)
+            self.writer.write(self.h2.data_to_send())
+            self.stream_freed.set()
+
+    def close(self):
+        self.closed = True
+        self._reader_task.cancel()
+        self.writer.close()
+
+
+class DoHChannel(DoTChannel):
+    """DNS-over-HTTPS查询通道：每条HTTP/2连接上并发多个流，连接建立与每个流的延迟分开统计"""
+
+    default_port = 443
+    connection_class = _H2Connection
+
+    def __init__(self, target, connections=1, **options):
+        super().__init__(target, connections, **options)
+        self.ssl_context.set_alpn_protocols(['h2'])
+        self.path = self.endpoint.path
+        self.authority = self.endpoint.host if self.endpoint.port == 443 else f"{self.endpoint.host}:{self.endpoint.port}"
+        self.transport_info = target.transport_info
+
+    async def _connect(self, timeout):
+        reader, writer = await super()._connect(timeout)
+        protocol = writer.get_extra_info('ssl_object').selected_alpn_protocol()
+        if protocol != 'h2':
+            writer.close()
+            raise ConnectionError(f"服务器不支持HTTP/2（ALPN协商结果: {protocol}）")
+        return reader, writer
+
+    async def _query_on(self, connection, domain, timeout, rdtype, timing=None):
+        # RFC 8484建议DoH查询的事务ID固定为0，便于HTTP缓存
+        wire = bytes(get_query_template(domain, rdtype).render(0))
+        stream_id = None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            # 检查空闲流与发送请求之间没有await，不会被其他查询抢占
+            while not connection.has_stream_slot():
+                await asyncio.wait_for(connection.wait_for_stream_change(), deadline - loop.time())
+            start_time = time.perf_counter()
+            stream_id, future = connection.send_request(wire, self.path, self.authority)
+            if timing is not None:
+                timing['sent'] = start_time
+            status, data, end_time = await asyncio.wait_for(future, timeout)
+            if timing is not None:
+                timing['received'] = end_time
+            if status != '200':
+                return False, QueryFailure(f"HTTP {status}", "服务器返回错误状态码")
+            response = dns.message.from_wire(data)
+        except asyncio.TimeoutError:
+            if stream_id is not None:
+                connection.cancel_request(stream_id)
+            return False, QueryFailure('Timeout', f"DNS查询在{timeout}秒内未收到响应")
+        except Exception as e:
+            return False, QueryFailure(type(e).__name__, e)
+        return _evaluate_response(response, start_time, end_time)
+
+    def close(self):
+        peak_streams = max((connection.peak_streams for connection in self.connections if connection is not None),
+                           default=0)
+        self.transport_info['单连接峰值并发流'] = max(self.transport_info.get('单连接峰值并发流', 0), peak_streams)
+        limits = [connection.h2.remote_settings.max_concurrent_streams
+                  for connection in self.connections if connection is not None]
+        if limits:
+            self.transport_info['服务器允许的最大并发流'] = min(limits)
+        super().close()
+
+CHANNELS = {
+    'udp': UDPChannel,
+    'tcp': TCPChannel,
+    'dot': DoTChannel,
+    'doh': DoHChannel,
+}
+
+
+class LatencyHistogram:
+    """HDR风格的对数-线性分桶延迟直方图：固定内存、O(1)记录，数值单位为微秒"""
+
+    def __init__(self, significant_digits=3, highest_value=3600 * 10**6):
+        # 每个对数桶内的线性子桶数，保证相对误差不超过10^-significant_digits
+        sub_bucket_count = 1 << (2 * 10**significant_digits - 1).bit_length()
+        self.significant_digits = significant_digits
+        self.highest_value = highest_value
+        self.sub_bucket_half_count_magnitude = sub_bucket_count.bit_length() - 2
+        self.sub_bucket_half_count = sub_bucket_count // 2
+        self.sub_bucket_mask = sub_bucket_count - 1
+
+        bucket_count = 1
+        smallest_untrackable_value = sub_bucket_count
+        while smallest_untrackable_value <= highest_value:
+            smallest_untrackable_value <<= 1
+            bucket_count += 1
+        self.counts = array('Q', bytes(8 * (bucket_count + 1) * self.sub_bucket_half_count))
+
+        self.total_count = 0
+        self.min_value = None
+        self.max_value = 0
+        self.value_sum = 0
+
+    def _counts_index(self, value):
+        bucket_index = (value | self.sub_bucket_mask).bit_length() - (self.sub_bucket_half_count_magnitude + 1)
+        sub_bucket_index = value >> bucket_index
+        return ((bucket_index + 1) << self.sub_bucket_half_count_magnitude) + sub_bucket_index - self.sub_bucket_half_count
+
+    def _highest_equivalent_value(self, index):
+        bucket_index = (index >> self.sub_bucket_half_count_magnitude) - 1
+        sub_bucket_index = (index & (self.sub_bucket_half_count - 1)) + self.sub_bucket_half_count
+        if bucket_index < 0:
+            sub_bucket_index -= self.sub_bucket_half_count
+            bucket_index = 0
+        return ((sub_bucket_index + 1) << bucket_index) - 1
+
+    def record(self, value, count=1):
+        """记录一个延迟值（微秒），超出范围的值按上限记录"""
+        value = min(max(int(value), 0), self.highest_value)
+        self.counts[self._counts_index(value)] += count
+        self.total_count += count
+        self.value_sum += value * count
+        if self.min_value is None or value < self.min_value:
+            self.min_value = value
+        if value > self.max_value:
+            self.max_value = value
+
+    def record_ms(self, latency_ms):
+        self.record(round(latency_ms * 1000))
+
+    def percentiles(self, percents):
+        """一次遍历计算多个百分位数（微秒），percents需升序"""
+        targets = [max(1, -(-self.total_count * percent // 100)) for percent in percents]
+        values = []
+        cumulative = 0
+        position = 0
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            cumulative += count
+            while position < len(targets) and cumulative >= targets[position]:
+                values.append(min(self._highest_equivalent_value(index), self.max_value))
+                position += 1
+            if position == len(targets):
+                break
+        return values
+
+    @property
+    def mean(self):
+        return self.value_sum / self.total_count if self.total_count else 0.0
+
+    def add(self, other):
+        """合并另一个直方图，分桶参数一致时逐桶相加"""
+        if not other.total_count:
+            return
+        if (other.significant_digits, other.highest_value) == (self.significant_digits, self.highest_value):
+            counts = self.counts
+            for index, count in enumerate(other.counts):
+                if count:
+                    counts[index] += count
+            self.total_count += other.total_count
+            self.value_sum += other.value_sum
+            if self.min_value is None or other.min_value < self.min_value:
+                self.min_value = other.min_value
+            self.max_value = max(self.max_value, other.max_value)
+        else:
+            # 分桶参数不同，按对方每个桶的代表值重新记录
+            for index, count in enumerate(other.counts):
+                if count:
+                    self.record(min(other._highest_equivalent_value(index), other.max_value), count)
+
+    def to_dict(self):
+        """序列化为只包含非空桶的紧凑结构"""
+        return {
+            'significant_digits': self.significant_digits,
+            'highest_value': self.highest_value,
+            'min': self.min_value,
+            'max': self.max_value,
+            'sum': self.value_sum,
+            'counts': [[index, count] for index, count in enumerate(self.counts) if count],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['significant_digits'], data['highest_value'])
+        for index, count in data['counts']:
+            histogram.counts[index] = count
+            histogram.total_count += count
+        histogram.min_value = data['min']
+        histogram.max_value = data['max']
+        histogram.value_sum = data['sum']
+        return histogram
+
+
+RESULT_FORMAT_VERSION = 1  # 可合并结果文件的格式版本
+
+class ProbeStats:
+    """测试结果统计：成功/失败计数和延迟直方图，内存占用与样本数无关"""
+
+    def __init__(self, significant_digits=3):
+        self.success_count = 0
+        self.failure_count = 0
+        self.histogram = LatencyHistogram(significant_digits)
+
+    def record(self, success, result):
+        """记录一次测试结果，成功时result为延迟（毫秒）"""
+        if success:
+            self.success_count += 1
+            self.histogram.record_ms(result)
+        else:
+            self.failure_count += 1
+
+    @property
+    def total(self):
+        return self.success_count + self.failure_count
+
+    def merge(self, other):
+        """合并另一份统计结果"""
+        self.success_count += other.success_count
+        self.failure_count += other.failure_count
+        self.histogram.add(other.histogram)
+
+    def to_dict(self):
+        return {
+            'format': RESULT_FORMAT_VERSION,
+            'success_count': self.success_count,
+            'failure_count': self.failure_count,
+            'histogram': self.histogram.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('format') != RESULT_FORMAT_VERSION:
+            raise ValueError(f"不支持的结果文件格式: {data.get('format')}")
+        stats = cls()
+        stats.success_count = data['success_count']
+        stats.failure_count = data['failure_count']
+        stats.histogram = LatencyHistogram.from_dict(data['histogram'])
+        return stats
+
+
+def save_results(path, results):
+    """把{服务器名称: ProbeStats}保存为可合并的JSON结果文件，每个服务器单独保存一份统计"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'format': RESULT_FORMAT_VERSION,
+            'targets': {name: stats.to_dict() for name, stats in results.items()},
+        }, f, ensure_ascii=False, separators=(',', ':'))
+
+
+def load_results(path):
+    """读取结果文件，返回{服务器名称: ProbeStats}"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('format') != RESULT_FORMAT_VERSION:
+        raise ValueError(f"不支持的结果文件格式: {data.get('format')}")
+    if 'targets' not in data:
+        raise ValueError("结果文件中没有按服务器保存的统计（targets）")
+    return {name: ProbeStats.from_dict(stats) for name, stats in data['targets'].items()}
+
+
+def classify_result(success, result):
+    """取出测试结果的响应码和错误类型，返回(rcode, error_class)；失败结果为QueryFailure，
+    超时、网络错误等没有收到响应时rcode为None"""
+    if success:
+        return 'NOERROR', None
+    return result.rcode, result.error_class
+
+
+class SampleWriter:
+    """逐样本输出JSON Lines记录：先写入内存缓冲区，按时间间隔或缓冲区大小批量刷新，内存占用与样本数无关"""
+
+    def __init__(self, stream, flush_interval=1.0, buffer_size=1 << 20, close_stream=False):
+        self.stream = stream  # 二进制流
+        self.close_stream = close_stream
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self._lines = []
+        self._buffered = 0
+        self._flushed_at = time.monotonic()
+
+    @classmethod
+    def open(cls, path, append=False):
+        """打开结果文件，'-'表示标准输出"""
+        if path == '-':
+            return cls(sys.stdout.buffer)
+        return cls(open(path, 'ab' if append else 'wb'), close_stream=True)
+
+    def write(self, target, domain, rdtype, success, result):
+        rcode, error_class = classify_result(success, result)
+        line = json.dumps({
+            'timestamp': round(time.time(), 6),
+            'target': target,
+            'domain': domain,
+            'qtype': rdtype,
+            'rcode': rcode,
+            'latency_ns': round(result * 10**6) if success else None,
+            'error': error_class,
+        }, ensure_ascii=False, separators=(',', ':')) + '\n'
+        self._lines.append(line)
+        self._buffered += len(line)
+        if self._buffered >= self.buffer_size or time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            # 一次write写出整批记录，多个进程追加同一文件时记录不会交错
+            self.stream.write(''.join(self._lines).encode('utf-8'))
+            self._lines.clear()
+            self._buffered = 0
+        self.stream.flush()
+        self._flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+        if self.close_stream:
+            self.stream.close()
+
+
+BINARY_MAGIC = b'DNSLATB1'
+BINARY_CHUNK_HEADER = struct.Struct('<II')  # 本块记录数, 保留
+BINARY_CHUNK_RECORDS = 65536
+BINARY_COLUMNS = (('timestamp', 'q'), ('latency', 'I'), ('target', 'H'), ('rcode', 'B'))  # 按宽度降序，列内自然对齐
+BINARY_FAILED = 0xFFFFFFFF  # 延迟列：查询失败
+BINARY_NO_RESPONSE = 0xFF  # 响应码列：没有收到响应
+
+
+class BinarySampleWriter:
+    """逐样本输出紧凑的二进制列式记录：文件头之后是若干数据块，每块依次存放int64时间戳（纳秒）、
+    uint32延迟（微秒）、uint16目标编号和uint8响应码四列，每条记录15字节；
+    记录写入预先分配的列缓冲区，块满或超过刷新间隔时整块写出"""
+
+    def __init__(self, stream, target_names, flush_interval=1.0, close_stream=False):
+        self.stream = stream
+        self.close_stream = close_stream
+        self.flush_interval = flush_interval
+        self.target_ids = {name: index for index, name in enumerate(target_names)}
+        self.columns = [array(typecode, bytes(array(typecode).itemsize * BINARY_CHUNK_RECORDS))
+                        for _, typecode in BINARY_COLUMNS]
+        self.size = 0
+        self._flushed_at = time.monotonic()
+
+    @classmethod
+    def open(cls, path, target_names, append=False):
+        """打开结果文件，append为False时写入包含目标名称表的文件头"""
+        stream = open(path, 'ab' if append else 'wb')
+        if not append:
+            header = json.dumps({'byteorder': sys.byteorder, 'targets': list(target_names)},
+                                ensure_ascii=False).encode('utf-8')
+            header += b' ' * (-len(header) % 8)  # 数据块从8字节边界开始
+            stream.write(BINARY_MAGIC + struct.pack('<I', len(header)) + b'\0' * 4 + header)
+            stream.flush()  # 工作进程随后以追加方式写入数据块
+        return cls(stream, target_names, close_stream=True)
+
+    def write(self, target, domain, rdtype, success, result):
+        rcode, _ = classify_result(success, result)
+        index = self.size
+        timestamps, latencies, target_ids, rcodes = self.columns
+        timestamps[index] = time.time_ns()
+        latencies[index] = min(round(result * 1000), BINARY_FAILED - 1) if success else BINARY_FAILED
+        target_ids[index] = self.target_ids[target]
+        rcodes[index] = dns.rcode.from_text(rcode) if rcode else BINARY_NO_RESPONSE
+        self.size += 1
+        if self.size == BINARY_CHUNK_RECORDS or time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.size:
+            size = self.size
+            parts = [BINARY_CHUNK_HEADER.pack(size, 0)]
+            parts.extend(memoryview(column)[:size] for column in self.columns)
+            length = BINARY_CHUNK_HEADER.size + size * sum(column.itemsize for column in self.columns)
+            parts.append(b'\0' * (-length % 8))
+            # 整块一次写出，多个进程追加同一文件时数据块不会交错
+            self.stream.write(b''.join(parts))
+            self.size = 0
+        self.stream.flush()
+        self._flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+        if self.close_stream:
+            self.stream.close()
+
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    engine TEXT,
+    transport TEXT,
+    command TEXT
+);
+CREATE TABLE IF NOT EXISTS samples (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    timestamp REAL NOT NULL,
+    day TEXT NOT NULL,
+    target TEXT NOT NULL,
+    domain TEXT,
+    qtype TEXT,
+    rcode TEXT,
+    latency_us INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS samples_target_day_latency ON samples (target, day, latency_us);
+CREATE INDEX IF NOT EXISTS samples_run ON samples (run_id);
+"""
+
+
+def connect_store(path):
+    """打开SQLite结果库：WAL模式下写入不阻塞读取，多个进程可以轮流提交"""
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(STORE_SCHEMA)
+    return connection
+
+
+def create_store_run(path, engine, transport, command):
+    """记录一次测试运行，返回运行编号"""
+    with closing(connect_store(path)) as connection, connection:
+        return connection.execute(
+            'INSERT INTO runs (started_at, engine, transport, command) VALUES (?, ?, ?, ?)',
+            (time.time(), engine, transport, command)).lastrowid
+
+
+def finish_store_run(path, run_id):
+    with closing(connect_store(path)) as connection, connection:
+        connection.execute('UPDATE runs SET finished_at = ? WHERE id = ?', (time.time(), run_id))
+
+
+class SQLiteSampleStore:
+    """把每个样本写入SQLite结果库：样本先在内存中攒批，再交给后台线程在一个事务中批量插入，
+    提交不占用测试循环；后台线程来不及写入或无法打开结果库时丢弃样本并计数，不阻塞测试循环"""
+
+    def __init__(self, path, run_id, batch_size=10000, flush_interval=1.0):
+        self.path = path
+        self.run_id = run_id
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0  # 队列已满时丢弃的样本数（测试线程计数）
+        self.failed = 0  # 写入失败的样本数（后台线程计数）
+        self._rows = []
+        self._flushed_at = time.monotonic()
+        self._batches = queue.Queue(maxsize=8)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, target, domain, rdtype, success, result):
+        rcode, error_class = classify_result(success, result)
+        self._rows.append((time.time(), target, domain, rdtype, rcode,
+                           round(result * 1000) if success else None, error_class))
+        if len(self._rows) >= self.batch_size or time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            try:
+                self._batches.put_nowait(self._rows)
+            except queue.Full:
+                self.dropped += len(self._rows)
+            self._rows = []
+        self._flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+        # 后台线程始终在取队列，等待它处理完剩余批次
+        self._batches.put(None)
+        self._thread.join()
+        if self.dropped or self.failed:
+            print(f"结果库写入不及时或失败，共丢弃{self.dropped + self.failed}个样本", file=sys.stderr)
+
+    def _run(self):
+        # SQLite连接只能在创建它的线程中使用
+        try:
+            connection = connect_store(self.path)
+        except sqlite3.Error as e:
+            # 打开失败时继续取出批次并计为失败，队列不会占满，flush和close不会阻塞
+            print(f"打开结果库失败，样本将不会写入: {type(e).__name__}: {e}", file=sys.stderr)
+            connection = None
+        try:
+            while True:
+                rows = self._batches.get()
+                if rows is None:
+                    return
+                if connection is None:
+                    self.failed += len(rows)
+                    continue
+                try:
+                    with connection:
+                        connection.executemany(
+                            'INSERT INTO samples (run_id, timestamp, day, target, domain, qtype, rcode, latency_us, error) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            ((self.run_id, timestamp, time.strftime('%Y-%m-%d', time.localtime(timestamp)), *row)
+                             for timestamp, *row in rows))
+                except sqlite3.Error as e:
+                    self.failed += len(rows)
+                    print(f"写入结果库失败，丢弃{len(rows)}个样本: {type(e).__name__}: {e}", file=sys.stderr)
+        finally:
+            if connection is not None:
+                connection.close()
+
+
+def open_sample_writers(args, target_names, append=False):
+    """按--output和--store打开逐样本输出，append用于工作进程追加到主进程已创建的文件"""
+    writers = []
+    if args.output == 'binary':
+        writers.append(BinarySampleWriter.open(args.output_file, target_names, append))
+    elif args.output == 'jsonl':
+        writers.append(SampleWriter.open(args.output_file, append))
+    if args.store:
+        writers.append(SQLiteSampleStore(args.store_path, args.store_run_id))
+    return writers
+
+
+def read_binary_samples(path, significant_digits=3):
+    """内存映射读取二进制样本文件并逐块统计，返回(目标名称列表, 每个目标的ProbeStats, 每个目标的响应码计数, 时间范围)"""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:8] != BINARY_MAGIC:
+            raise ValueError('不是二进制样本文件')
+        header_size, = struct.unpack_from('<I', data, 8)
+        header = json.loads(data[16:16 + header_size])
+        names = header['targets']
+        swap = header['byteorder'] != sys.byteorder
+        stats = [ProbeStats(significant_digits) for _ in names]
+        rcodes = [defaultdict(int) for _ in names]
+        first_time = last_time = None
+        offset = 16 + header_size
+        while offset < len(data):
+            if offset + BINARY_CHUNK_HEADER.size > len(data):
+                raise ValueError('文件不完整')
+            size, _ = BINARY_CHUNK_HEADER.unpack_from(data, offset)
+            offset += BINARY_CHUNK_HEADER.size
+            columns = []
+            for _, typecode in BINARY_COLUMNS:
+                column = array(typecode)
+                length = size * column.itemsize
+                if offset + length > len(data):
+                    raise ValueError('文件不完整')
+                column.frombytes(data[offset:offset + length])
+                if swap:
+                    column.byteswap()
+                columns.append(column)
+                offset += length
+            offset += -offset % 8
+            timestamps, latencies, target_ids, rcode_column = columns
+            if size:
+                first_time = min(timestamps) if first_time is None else min(first_time, min(timestamps))
+                last_time = max(timestamps) if last_time is None else max(last_time, max(timestamps))
+            # 先按(目标, 延迟)计数再批量记入直方图，避免逐条记录
+            for (target_id, latency), count in Counter(zip(target_ids, latencies)).items():
+                if latency == BINARY_FAILED:
+                    stats[target_id].failure_count += count
+                else:
+                    stats[target_id].success_count += count
+                    stats[target_id].histogram.record(latency, count)
+            for (target_id, rcode), count in Counter(zip(target_ids, rcode_column)).items():
+                rcodes[target_id][rcode] += count
+    return names, stats, rcodes, (first_time, last_time)
+
+
+def _parse_domain_line(line):
+    """从域名列表的一行中取出域名，兼容"排名,域名"格式的CSV，空行和#注释返回None"""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    return line.rsplit(',', 1)[-1].strip() or None
+
+def iter_domains_sequential(path):
+    """按文件顺序逐行读取域名，读到末尾后从头循环"""
+    while True:
+        found = False
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                domain = _parse_domain_line(line)
+                if domain:
+                    found = True
+                    yield domain
+        if not found:
+            raise ValueError(f"域名列表文件中没有可用的域名: {path}")
+
+def iter_domains_shuffled(path, buffer_size=10000):
+    """流式乱序：用固定大小的缓冲区随机抽取，不把整个文件读入内存"""
+    buffer = []
+    for domain in iter_domains_sequential(path):
+        if len(buffer) < buffer_size:
+            buffer.append(domain)
+            continue
+        index = random.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = domain
+
+def iter_domains_zipf(path, exponent=1.0):
+    """按Zipf分布加权抽样：文件中第k个域名被抽中的概率与1/k^exponent成正比（适用于按热度排序的列表）"""
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError(f"域名列表文件为空: {path}")
+    # 只为有效行建立偏移量索引，域名内容留在内存映射中按需读取
+    offsets = array('Q')
+    position = 0
+    while position < len(data):
+        end = data.find(b'\n', position)
+        if end < 0:
+            end = len(data)
+        if _parse_domain_line(data[position:end].decode('utf-8', 'replace')):
+            offsets.append(position)
+        position = end + 1
+    if not offsets:
+        raise ValueError(f"域名列表文件中没有可用的域名: {path}")
+
+    # 离散Zipf分布：排名k的权重为1/k^exponent，按累积权重表二分查找抽样（与iter_qtypes相同的批量抽样）
+    cum_weights = array('d', itertools.accumulate(rank ** -exponent for rank in range(1, len(offsets) + 1)))
+    while True:
+        for start in random.choices(offsets, cum_weights=cum_weights, k=1024):
+            end = data.find(b'\n', start)
+            yield _parse_domain_line(data[start:end if end >= 0 else len(data)].decode('utf-8', 'replace'))
+
+def parse_qtype_mix(text):
+    """解析"A=70,AAAA=20"形式的查询类型权重，返回{记录类型: 权重}"""
+    mix = {}
+    for item in text.split(','):
+        rdtype, _, weight = item.strip().partition('=')
+        try:
+            rdtype = dns.rdatatype.to_text(dns.rdatatype.from_text(rdtype.strip()))
+        except dns.rdatatype.UnknownRdatatype:
+            raise ValueError(f"未知的记录类型: {rdtype.strip()}")
+        weight = float(weight) if weight else 1.0
+        if weight < 0:
+            raise ValueError(f"{rdtype}的权重不能为负数")
+        mix[rdtype] = mix.get(rdtype, 0) + weight
+    if not any(mix.values()):
+        raise ValueError("权重之和必须大于0")
+    return mix
+
+def iter_qtypes(mix, batch_size=1024):
+    """按权重无限抽样查询类型，批量抽样以降低每次查询的开销"""
+    rdtypes = list(mix)
+    cum_weights = list(itertools.accumulate(mix.values()))
+    while True:
+        yield from random.choices(rdtypes, cum_weights=cum_weights, k=batch_size)
+
+DOMAIN_ORDERS = {
+    'sequential': iter_domains_sequential,
+    'shuffle': iter_domains_shuffled,
+    'zipf': iter_domains_zipf,
+}
+
+
+class ProbeTarget:
+    """一个被测DNS服务器：端点缓存、端口连接性缓存和统计结果；
+    check_port为False时不探测端口连接性（health为None），用于工作进程和校准等只运行async引擎的场合"""
+
+    def __init__(self, dns_server, timeout=5, probe_interval=30, significant_digits=3, default_port=53,
+                 check_port=True):
+        self.name = dns_server
+        # 服务器地址每次运行只解析一次，测试循环中只执行被测量的查询
+        self.endpoint = ServerEndpoint(dns_server, timeout, default_port)
+        self.health = EndpointHealth(self.endpoint, probe_interval) if check_port else None
+        self.significant_digits = significant_digits
+        self.stats = ProbeStats(significant_digits)
+        self.corrected_stats = ProbeStats(significant_digits)
+        self.kernel_stats = ProbeStats(significant_digits)  # 基于内核接收时间戳的延迟
+        self.type_stats = {}  # 记录类型 -> ProbeStats
+        self.setup_stats = defaultdict(lambda: LatencyHistogram(significant_digits))  # 建连阶段 -> 耗时直方图
+        self.transport_info = {}  # 传输方式相关的附加信息，如DoH的并发流数
+        self.sample_writers = []  # 逐样本输出（--output、--store）
+        self.phase_stats = defaultdict(  # 查询阶段 -> 耗时直方图（纳秒）
+            lambda: LatencyHistogram(significant_digits, highest_value=3600 * 10**9))
+
+    def record(self, rdtype, success, result, domain=None):
+        """记录一次测试结果，同时计入总体统计和按记录类型的统计，需要时逐样本输出"""
+        for writer in self.sample_writers:
+            writer.write(self.name, domain, rdtype, success, result)
+        self.stats.record(success, result)
+        type_stats = self.type_stats.get(rdtype)
+        if type_stats is None:
+            type_stats = self.type_stats[rdtype] = ProbeStats(self.significant_digits)
+        type_stats.record(success, result)
+
+    def to_dict(self):
+        """序列化统计结果（不含端点等运行状态），用于工作进程把结果发回父进程"""
+        return {
+            'stats': self.stats.to_dict(),
+            'corrected_stats': self.corrected_stats.to_dict(),
+            'type_stats': {rdtype: stats.to_dict() for rdtype, stats in self.type_stats.items()},
+            'setup_stats': {phase: histogram.to_dict() for phase, histogram in self.setup_stats.items()},
+            'transport_info': self.transport_info,
+        }
+
+    def merge_dict(self, data):
+        """合并其他进程中同一服务器的统计结果"""
+        self.stats.merge(ProbeStats.from_dict(data['stats']))
+        self.corrected_stats.merge(ProbeStats.from_dict(data['corrected_stats']))
+        for rdtype, stats in data['type_stats'].items():
+            if rdtype not in self.type_stats:
+                self.type_stats[rdtype] = ProbeStats(self.significant_digits)
+            self.type_stats[rdtype].merge(ProbeStats.from_dict(stats))
+        for phase, histogram in data['setup_stats'].items():
+            self.setup_stats[phase].add(LatencyHistogram.from_dict(histogram))
+        for name, value in data['transport_info'].items():
+            self.transport_info[name] = max(self.transport_info.get(name, value), value)
+
+
+async def _open_channels(targets, channel_factory, timeout):
+    """为每个目标打开一个查询通道，返回{目标: 通道}"""
+    channels = {}
+    try:
+        for target in targets:
+            channel = channel_factory(target)
+            channels[target] = await channel.open(timeout)
+    except Exception:
+        _close_channels(channels)
+        raise
+    return channels
+
+def _close_channels(channels):
+    for channel in channels.values():
+        channel.close()
+
+
+def iter_rounds(count, stop=None):
+    """依次产生测试轮次，stop返回True时提前结束（用于自适应采样），至少执行一轮"""
+    for i in range(count):
+        if i and stop is not None and stop():
+            return
+        yield i
+
+
+def iter_round_queries(targets, queries, count, stop=None):
+    """按轮次产生(目标, 域名, 记录类型)：每轮只抽取一次查询并发给所有目标，与serial引擎一致，
+    各目标测试的域名和记录类型相同"""
+    for _ in iter_rounds(count, stop):
+        domain, rdtype = next(queries)
+        for target in targets:
+            yield target, domain, rdtype
+
+
+async def run_async_engine(targets, queries, count, timeout, concurrency, channel_factory=UDPChannel, stop=None):
+    """异步并发测试引擎：所有目标交错排队，保持concurrency个查询同时在途"""
+
+    channels = await _open_channels(targets, channel_factory, timeout)
+    # 按轮次交错各个目标，使它们在相同的网络条件下被测试
+    remaining = iter_round_queries(targets, queries, count, stop)
+
+    async def worker():
+        for target, domain, rdtype in remaining:
+            target.record(rdtype, *await channels[target].query(domain, timeout, rdtype), domain)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, count * len(targets)))))
+    finally:
+        _close_channels(channels)
+
+
+SCHEDULE_SPIN_MARGIN = 0.002  # asyncio.sleep按毫秒取整唤醒，提前该值（秒）醒来，剩余时间让出事件循环等待
+MAX_SEND_BURST = 256  # 落后于计划时连续补发的查询数上限，之后让出一次事件循环使查询真正发出
+LATE_SEND_THRESHOLD = 0.002  # 实际发送晚于计划时间超过该值（秒）即视为迟发，需大于定时器精度
+REPORT_PERCENTILES = (50, 90, 99, 99.9, 99.99)
+
+async def _scheduled_query(channel, domain, rdtype, timeout, intended_time):
+    """按计划时间发送的查询，返回原始结果、从计划发送时间起算的校正结果，
+    以及报文实际发出时相对计划时间的延后（秒，未能发出时为None）"""
+    timing = {}
+    success, result = await channel.query(domain, timeout, rdtype, timing)
+    lateness = timing['sent'] - intended_time if 'sent' in timing else None
+    if success:
+        # 协调遗漏校正：从计划发送时间算到收到响应，排队造成的发送延后也计入延迟
+        return (success, result), (success, (timing['received'] - intended_time) * 1000), lateness
+    return (success, result), (success, result), lateness
+
+async def run_open_loop_engine(targets, queries, count, timeout, qps, channel_factory=UDPChannel, stop=None):
+    """开环恒定速率测试引擎：每个目标按qps的速率交错发送查询，不等待响应，返回发送情况统计"""
+    channels = await _open_channels(targets, channel_factory, timeout)
+    tasks = set()
+    late_count = 0
+    max_lateness = 0.0
+    sent = 0
+    interval = 1.0 / (qps * len(targets))
+
+    exhausted_count = 0
+
+    def _collect_scheduled_result(task):
+        nonlocal exhausted_count, late_count, max_lateness
+        tasks.discard(task)
+        raw, corrected, lateness = task.result()
+        # 按报文实际发出的时间判断迟发，包括调度和建立连接造成的延后
+        if lateness is not None and lateness > LATE_SEND_THRESHOLD:
+            late_count += 1
+            max_lateness = max(max_lateness, lateness)
+        if not raw[0] and raw[1].error_class == 'QueryIDExhausted':
+            exhausted_count += 1
+        target, domain, rdtype = pending_targets.pop(task)
+        target.record(rdtype, *raw, domain)
+        target.corrected_stats.record(*corrected)
+
+    pending_targets = {}
+    try:
+        # 发送时间由单调时钟上的起点加偏移计算，避免逐次sleep带来的累积漂移
+        start_time = time.perf_counter()
+        burst = 0
+        # 每轮抽取一次查询发给所有目标，stop在每轮开始时判断
+        for i, (target, domain, rdtype) in enumerate(iter_round_queries(targets, queries, count, stop)):
+            intended_time = start_time + i * interval
+            delay = intended_time - time.perf_counter()
+            if delay > SCHEDULE_SPIN_MARGIN:
+                await asyncio.sleep(delay - SCHEDULE_SPIN_MARGIN)
+            if delay > 0 or burst >= MAX_SEND_BURST:
+                burst = 0
+                # 不足一个定时器精度的剩余时间逐次让出事件循环，期间照常处理响应
+                await asyncio.sleep(0)
+                while time.perf_counter() < intended_time:
+                    await asyncio.sleep(0)
+            else:
+                # 已经落后于计划：到期的查询成批连续发送
+                burst += 1
+            task = asyncio.ensure_future(
+                _scheduled_query(channels[target], domain, rdtype, timeout, intended_time))
+            tasks.add(task)
+            pending_targets[task] = (target, domain, rdtype)
+            task.add_done_callback(_collect_scheduled_result)
+            sent += 1
+        send_duration = time.perf_counter() - start_time
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        _close_channels(channels)
+
+    achieved_qps = (sent - 1) / send_duration if sent > 1 and send_duration > 0 else qps * len(targets)
+    return {'achieved_qps': achieved_qps, 'late_count': late_count, 'max_lateness': max_lateness,
+            'exhausted_count': exhausted_count}
+
+
+def print_send_stats(send_stats):
+    """输出开环模式的实际发送速率和迟发情况"""
+    print(f"实际发送速率: {send_stats['achieved_qps']:.1f} QPS")
+    print(f"迟发次数: {send_stats['late_count']}（超过{LATE_SEND_THRESHOLD * 1000:.0f} ms），"
+          f"最大迟发: {send_stats['max_lateness'] * 1000:.2f} ms")
+    if send_stats['exhausted_count']:
+        # 服务器不再应答时在途查询按qps×超时时间累积，超过事务ID容量的发送直接计为失败
+        print(f"事务ID耗尽直接失败: {send_stats['exhausted_count']}次")
+
+
+def print_comparison(title, stats, other_stats):
+    """并列输出两组延迟的分位数，如原始延迟与协调遗漏校正后的延迟"""
+    raw, corrected = stats.histogram, other_stats.histogram
+    if not raw.total_count or not corrected.total_count:
+        return
+    print(f"=== 延迟分布（{title}） ===")
+    for percent, raw_value, corrected_value in zip(
+            REPORT_PERCENTILES, raw.percentiles(REPORT_PERCENTILES), corrected.percentiles(REPORT_PERCENTILES)):
+        print(f"p{percent}: {raw_value / 1000:.2f} ms / {corrected_value / 1000:.2f} ms")
+    print(f"最大: {raw.max_value / 1000:.2f} ms / {corrected.max_value / 1000:.2f} ms")
+
+
+def print_summary(stats, title=None):
+    """输出测试结果汇总，title用于区分多个服务器"""
+    total = stats.total
+    success_count = stats.success_count
+    histogram = stats.histogram
+
+    print("-" * 50)
+    print(f"=== 测试结果汇总{f' [{title}]' if title else ''} ===")
+    print(f"总测试次数: {total}")
+    print(f"成功次数: {success_count}")
+    print(f"失败次数: {total - success_count}")
+    if not total:
+        return
+    print(f"成功率: {success_count/total*100:.2f}%")
+
+    if histogram.total_count:
+        print(f"最小延迟: {histogram.min_value / 1000:.2f} ms")
+        print(f"最大延迟: {histogram.max_value / 1000:.2f} ms")
+        print(f"平均延迟: {histogram.mean / 1000:.2f} ms")
+        percentiles = histogram.percentiles(REPORT_PERCENTILES)
+        print("延迟分位数: " + ", ".join(
+            f"p{percent}={value / 1000:.2f} ms" for percent, value in zip(REPORT_PERCENTILES, percentiles)))
+
+
+def print_setup_stats(target):
+    """输出连接建立各阶段的耗时（与查询延迟分开统计）"""
+    print(f"=== 连接建立耗时 ===")
+    for phase, histogram in target.setup_stats.items():
+        p50, p99 = histogram.percentiles((50, 99))
+        print(f"{phase}: {histogram.total_count}次, 平均 {histogram.mean / 1000:.2f} ms, "
+              f"p50={p50 / 1000:.2f} ms, p99={p99 / 1000:.2f} ms")
+
+
+def print_phase_stats(target):
+    """输出查询各阶段的耗时分布，用于区分客户端、网络和服务器的耗时"""
+    print(f"=== 各阶段耗时 ===")
+    for phase, histogram in target.phase_stats.items():
+        p50, p99 = histogram.percentiles((50, 99))
+        print(f"{phase}: 平均 {histogram.mean / 1000:.1f} us, p50={p50 / 1000:.1f} us, p99={p99 / 1000:.1f} us")
+
+
+def print_type_breakdown(target):
+    """按记录类型输出各自的成功率和延迟分位数"""
+    print(f"=== 按记录类型统计 ===")
+    for rdtype, stats in sorted(target.type_stats.items(), key=lambda item: -item[1].total):
+        line = f"{rdtype}: {stats.total}次, 成功率 {stats.success_count / stats.total * 100:.2f}%"
+        if stats.histogram.total_count:
+            p50, p99 = stats.histogram.percentiles((50, 99))
+            line += f", 平均 {stats.histogram.mean / 1000:.2f} ms, p50={p50 / 1000:.2f} ms, p99={p99 / 1000:.2f} ms"
+        print(line)
+
+
+def _display_width(text):
+    """终端显示宽度，中文等全角字符占两列"""
+    return sum(2 if unicodedata.east_asian_width(char) in 'WF' else 1 for char in text)
+
+def _pad(text, width, align='<'):
+    padding = ' ' * max(0, width - _display_width(text))
+    return text + padding if align == '<' else padding + text
+
+def print_ranking(results):
+    """多个服务器并列对比：results为[(服务器名称, ProbeStats)]，按中位延迟排名，全部失败的服务器排在最后"""
+    rows = []
+    for name, stats in results:
+        histogram = stats.histogram
+        if histogram.total_count:
+            p50, p99 = histogram.percentiles((50, 99))
+            rows.append((0, p50, name, stats, f"{histogram.mean / 1000:.2f}", f"{p50 / 1000:.2f}",
+                         f"{p99 / 1000:.2f}", f"{histogram.max_value / 1000:.2f}"))
+        else:
+            rows.append((1, 0, name, stats, '-', '-', '-', '-'))
+    rows.sort(key=lambda row: (row[0], row[1]))
+
+    name_width = max(_display_width('DNS服务器'), *(_display_width(name) for name, _ in results))
+    print("-" * 50)
+    print(f"=== 服务器对比（按中位延迟排名） ===")
+    print(' '.join(_pad(text, width, align) for text, width, align in (
+        ('排名', 4, '<'), ('DNS服务器', name_width, '<'), ('成功率', 8, '>'), ('平均(ms)', 10, '>'),
+        ('p50(ms)', 10, '>'), ('p99(ms)', 10, '>'), ('最大(ms)', 10, '>'))))
+    for rank, (_, _, name, stats, mean, p50, p99, maximum) in enumerate(rows, 1):
+        success_rate = f"{stats.success_count / stats.total * 100:.2f}%" if stats.total else '-'
+        print(f"{rank:<4} {_pad(name, name_width)} {success_rate:>8} {mean:>10} {p50:>10} {p99:>10} {maximum:>10}")
+
+
+def run_serial_engine(targets, queries, count, timeout, phases=False, kernel_timestamps=False, stop=None):
+    """顺序测试引擎：逐次执行查询，多个服务器按轮次交错，两轮测试之间间隔0.5秒"""
+    for i in iter_rounds(count, stop):
+        domain, rdtype = next(queries)
+        for target in targets:
+            label = f"[{target.name}] " if len(targets) > 1 else ""
+            print(f"{label}第{i+1}次测试...", end=' ')
+            success, result = test_dns_latency(
+                dns_server=target.name,
+                domain=domain,
+                timeout=timeout,
+                endpoint=target.endpoint,
+                health=target.health,
+                rdtype=rdtype,
+                phase_stats=target.phase_stats if phases else None,
+                kernel_stats=target.kernel_stats if kernel_timestamps else None
+            )
+
+            if success:
+                print(f"成功，延迟: {result:.2f} ms")
+            else:
+                print(f"失败，原因: {result}")
+
+            target.record(rdtype, success, result, domain)
+        # 测试间隔（避免请求过于密集）
+        if i < count - 1:
+            time.sleep(0.5)
+
+def run_thread_engine(targets, queries, count, timeout, threads, stop=None):
+    """线程池测试引擎：在有界线程池中并发执行与serial引擎相同的阻塞查询，输出格式与serial一致，
+    返回线程数、平均并发度、峰值并发和排队等待时间"""
+    lock = threading.Lock()
+    # 限制已提交但未完成的任务数，避免一次性提交全部查询
+    slots = threading.BoundedSemaphore(threads * 2)
+    queue_wait = LatencyHistogram()
+    usage = {'busy': 0.0, 'in_flight': 0, 'peak': 0}
+
+    def probe(n, target, domain, rdtype, submitted_at):
+        try:
+            started_at = time.perf_counter()
+            with lock:
+                usage['in_flight'] += 1
+                usage['peak'] = max(usage['peak'], usage['in_flight'])
+            lines = []
+            success, result = test_dns_latency(
+                dns_server=target.name,
+                domain=domain,
+                timeout=timeout,
+                endpoint=target.endpoint,
+                health=target.health,
+                rdtype=rdtype,
+                log=lines.append
+            )
+            finished_at = time.perf_counter()
+            lines.append(f"成功，延迟: {result:.2f} ms" if success else f"失败，原因: {result}")
+            label = f"[{target.name}] " if len(targets) > 1 else ""
+            with lock:
+                usage['in_flight'] -= 1
+                usage['busy'] += finished_at - started_at
+                queue_wait.record_ms((started_at - submitted_at) * 1000)
+                target.record(rdtype, success, result, domain)
+                print(f"{label}第{n}次测试... " + "\n".join(lines))
+        finally:
+            slots.release()
+
+    # 只保留出错任务的异常，不为每个任务保存future；出错后停止提交，等已提交的任务结束后抛出
+    errors = []
+
+    def _collect_error(future):
+        if future.exception() is not None:
+            errors.append(future.exception())
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for i in iter_rounds(count, stop):
+            if errors:
+                break
+            domain, rdtype = next(queries)
+            for target in targets:
+                slots.acquire()
+                executor.submit(probe, i + 1, target, domain, rdtype, time.perf_counter()).add_done_callback(
+                    _collect_error)
+    if errors:
+        raise errors[0]
+    elapsed = time.perf_counter() - start_time
+    return {
+        'threads': threads,
+        'concurrency': usage['busy'] / elapsed if elapsed > 0 else 0.0,
+        'peak': usage['peak'],
+        'queue_wait': queue_wait,
+    }
+
+
+def print_thread_stats(thread_stats):
+    """输出threads引擎的实际并发度和排队等待时间"""
+    print(f"线程数: {thread_stats['threads']}，平均并发度: {thread_stats['concurrency']:.2f}，"
+          f"峰值并发: {thread_stats['peak']}")
+    queue_wait = thread_stats['queue_wait']
+    if queue_wait.total_count:
+        p50, p99 = queue_wait.percentiles((50, 99))
+        print(f"排队等待: 平均 {queue_wait.mean / 1000:.2f} ms, p50={p50 / 1000:.2f} ms, "
+              f"p99={p99 / 1000:.2f} ms, 最大 {queue_wait.max_value / 1000:.2f} ms")
+
+
+def read_dns_file(path):
+    """读取DNS服务器列表文件，每行一个服务器，忽略空行和#注释"""
+    servers = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                servers.append(line)
+    return servers
+
+def merge_main(argv):
+    """merge子命令：合并多个结果文件并输出汇总"""
+    parser = argparse.ArgumentParser(
+        prog='dns-delay-testing.py merge',
+        description='合并多个测试结果文件（由--save-result生成）并输出汇总'
+    )
+    parser.add_argument('files', nargs='+', help='结果文件')
+    parser.add_argument('--save-result', help='把合并后的结果保存到文件')
+    args = parser.parse_args(argv)
+
+    # 按服务器名称分别合并，不同服务器的延迟不混在同一个直方图中
+    merged = {}
+    for path in args.files:
+        try:
+            results = load_results(path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"无法读取结果文件 {path}: {type(e).__name__}: {e}")
+            sys.exit(1)
+        for name, stats in results.items():
+            if name not in merged:
+                merged[name] = ProbeStats(stats.histogram.significant_digits)
+            merged[name].merge(stats)
+
+    print(f"=== 合并 {len(args.files)} 个结果文件 ===")
+    if not any(stats.total for stats in merged.values()):
+        print("结果文件中没有测试记录")
+        return
+    for name, stats in merged.items():
+        if stats.total:
+            print_summary(stats, name if len(merged) > 1 else None)
+    if len(merged) > 1:
+        print_ranking([(name, stats) for name, stats in merged.items() if stats.total])
+    if args.save_result:
+        save_results(args.save_result, merged)
+        print(f"合并结果已保存到: {args.save_result}")
+
+def summary_main(argv):
+    """summary子命令：内存映射读取二进制样本文件，输出与测试结束时相同的汇总"""
+    parser = argparse.ArgumentParser(
+        prog='dns-delay-testing.py summary',
+        description='读取--output binary生成的样本文件并输出汇总'
+    )
+    parser.add_argument('file', help='二进制样本文件')
+    parser.add_argument('--significant-digits', type=int, choices=range(1, 6), default=3,
+                        help='延迟直方图的有效数字位数（1-5，默认：3）')
+    args = parser.parse_args(argv)
+
+    try:
+        names, stats, rcodes, (first_time, last_time) = read_binary_samples(args.file, args.significant_digits)
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        print(f"无法读取样本文件 {args.file}: {type(e).__name__}: {e}")
+        sys.exit(1)
+
+    print(f"=== 样本文件 {args.file} ===")
+    if first_time is None:
+        print("样本文件中没有测试记录")
+        return
+    print(f"时间范围: {datetime.fromtimestamp(first_time / 10**9).strftime('%Y-%m-%d %H:%M:%S')} - "
+          f"{datetime.fromtimestamp(last_time / 10**9).strftime('%Y-%m-%d %H:%M:%S')}")
+    results = [(name, target_stats) for name, target_stats in zip(names, stats) if target_stats.total]
+    for (name, target_stats), target_rcodes in zip(zip(names, stats), rcodes):
+        if not target_stats.total:
+            continue
+        print_summary(target_stats, name if len(results) > 1 else None)
+        print("响应码: " + ", ".join(
+            f"{'无响应' if rcode == BINARY_NO_RESPONSE else dns.rcode.to_text(rcode)}={count}"
+            for rcode, count in sorted(target_rcodes.items())))
+    if len(results) > 1:
+        print_ranking(results)
+
+
+def report_main(argv):
+    """report子命令：按服务器和日期从SQLite结果库中统计延迟分位数"""
+    parser = argparse.ArgumentParser(
+        prog='dns-delay-testing.py report',
+        description='按服务器和日期统计--store保存的历史延迟'
+    )
+    parser.add_argument('store', help='结果库文件（如results.db或sqlite:results.db）')
+    parser.add_argument('--target', help='只统计指定的DNS服务器（与测试时--dns的写法一致）')
+    parser.add_argument('--since', help='起始日期（含），格式如2024-01-01')
+    parser.add_argument('--until', help='结束日期（含），格式如2024-01-31')
+    parser.add_argument('--percentiles', default='50,90,99', help='要统计的百分位数（默认：50,90,99）')
+    args = parser.parse_args(argv)
+
+    path = args.store[len('sqlite:'):] if args.store.startswith('sqlite:') else args.store
+    try:
+        percents = sorted(float(value) for value in args.percentiles.split(','))
+    except ValueError:
+        parser.error(f"--percentiles格式错误: {args.percentiles}")
+    if not all(0 < percent <= 100 for percent in percents):
+        parser.error('--percentiles中的百分位数必须在0到100之间')
+
+    conditions, parameters = [], []
+    for column, operator, value in (('target', '=', args.target), ('day', '>=', args.since), ('day', '<=', args.until)):
+        if value:
+            conditions.append(f"{column} {operator} ?")
+            parameters.append(value)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    try:
+        open(path, 'rb').close()
+        with closing(connect_store(path)) as connection:
+            # 计数、平均和最大值只需扫描(target, day, latency_us)索引
+            groups = connection.execute(
+                f"SELECT target, day, COUNT(*), COUNT(latency_us), AVG(latency_us), MAX(latency_us) "
+                f"FROM samples {where} GROUP BY target, day ORDER BY target, day", parameters).fetchall()
+            rows = []
+            for target, day, total, success_count, mean, maximum in groups:
+                values = []
+                for percent in percents:
+                    if not success_count:
+                        values.append('-')
+                        continue
+                    # 与直方图相同的定义：第ceil(n*p/100)小的值，沿索引按延迟顺序定位
+                    rank = max(1, -(-success_count * percent // 100))
+                    latency, = connection.execute(
+                        'SELECT latency_us FROM samples WHERE target = ? AND day = ? AND latency_us IS NOT NULL '
+                        'ORDER BY latency_us LIMIT 1 OFFSET ?', (target, day, int(rank) - 1)).fetchone()
+                    values.append(f"{latency / 1000:.2f}")
+                rows.append((day, target, str(total), f"{success_count / total * 100:.2f}%",
+                             f"{mean / 1000:.2f}" if success_count else '-', *values,
+                             f"{maximum / 1000:.2f}" if success_count else '-'))
+    except (OSError, sqlite3.Error) as e:
+        print(f"无法读取结果库 {path}: {type(e).__name__}: {e}")
+        sys.exit(1)
+
+    print(f"=== 结果库 {path} ===")
+    if not rows:
+        print("没有符合条件的测试记录")
+        return
+    headers = ('日期', 'DNS服务器', '次数', '成功率', '平均(ms)', *(f"p{percent:g}(ms)" for percent in percents), '最大(ms)')
+    widths = [max(_display_width(header), *(_display_width(row[column]) for row in rows))
+              for column, header in enumerate(headers)]
+    aligns = ['<', '<'] + ['>'] * (len(headers) - 2)
+    print(' '.join(_pad(header, width, align) for header, width, align in zip(headers, widths, aligns)))
+    for row in rows:
+        print(' '.join(_pad(text, width, align) for text, width, align in zip(row, widths, aligns)))
+
+
+# 内置应答器为各记录类型返回的固定应答数据
+_RESPONDER_RDATA = {
+    dns.rdatatype.A: socket.inet_pton(socket.AF_INET, '127.0.0.1'),
+    dns.rdatatype.AAAA: socket.inet_pton(socket.AF_INET6, '::1'),
+    dns.rdatatype.NS: b'\xc0\x0c',
+    dns.rdatatype.CNAME: b'\xc0\x0c',
+    dns.rdatatype.PTR: b'\xc0\x0c',
+    dns.rdatatype.MX: b'\x00\x0a\xc0\x0c',
+    dns.rdatatype.TXT: b'\x02ok',
+    dns.rdatatype.SVCB: b'\x00\x01\x00',
+    dns.rdatatype.HTTPS: b'\x00\x01\x00',
+}
+
+def build_response(query, rcode=dns.rcode.NOERROR, ttl=60):
+    """直接在报文层面构造应答，不经过dnspython解析，返回None表示查询报文无效"""
+    if len(query) < 12 or query[2] & 0x80 or int.from_bytes(query[4:6], 'big') != 1:
+        return None
+    # 跳过问题节中的域名标签
+    position = 12
+    while position < len(query) and query[position]:
+        if query[position] & 0xC0:
+            return None
+        position += query[position] + 1
+    question_end = position + 5
+    if question_end > len(query):
+        return None
+    rdtype = int.from_bytes(query[position + 1:position + 3], 'big')
+    rdata = _RESPONDER_RDATA.get(rdtype) if rcode == dns.rcode.NOERROR else None
+
+    # QR=1，保留操作码和RD，设置RA
+    flags = 0x8000 | (query[2] & 0x79) << 8 | 0x80 | rcode
+    header = query[:2] + struct.pack('!HHHHH', flags, 1, 1 if rdata else 0, 0, 0)
+    response = header + query[12:question_end]
+    if rdata:
+        response += struct.pack('!HHHIH', 0xC00C, rdtype, 1, ttl, len(rdata)) + rdata
+    return response
+
+
+def parse_delay_spec(text):
+    """解析延迟分布（单位毫秒）：固定值、fixed:MS、uniform:MIN,MAX、exp:MEAN、normal:MEAN,STDDEV，
+    返回每次调用得到一个延迟（秒）的函数"""
+    kind, _, params = text.partition(':')
+    if not params:
+        kind, params = 'fixed', kind
+    try:
+        values = [float(value) / 1000 for value in params.split(',')]
+    except ValueError:
+        raise ValueError(f"无法解析延迟参数: {text}")
+    if any(value < 0 for value in values):
+        raise ValueError(f"延迟参数不能为负数: {text}")
+    samplers = {
+        ('fixed', 1): lambda: values[0],
+        ('uniform', 2): lambda: random.uniform(values[0], values[1]),
+        ('exp', 1): lambda: random.expovariate(1 / values[0]) if values[0] > 0 else 0.0,
+        ('normal', 2): lambda: max(0.0, random.gauss(values[0], values[1])),
+    }
+    sampler = samplers.get((kind, len(values)))
+    if sampler is None:
+        raise ValueError(f"不支持的延迟分布: {text}")
+    return sampler
+
+
+class Responder:
+    """本地DNS应答器：按配置的延迟分布、丢包率和SERVFAIL比例应答UDP和TCP查询"""
+
+    def __init__(self, delay=lambda: 0.0, drop_rate=0.0, servfail_rate=0.0, ttl=60):
+        self.delay = delay
+        self.drop_rate = drop_rate
+        self.servfail_rate = servfail_rate
+        self.ttl = ttl
+        self.counters = {'收到查询': 0, '丢弃': 0, 'SERVFAIL': 0}
+        self.servers = []
+
+    def respond(self, query, send):
+        """处理一个查询，按延迟分布稍后调用send发送应答"""
+        self.counters['收到查询'] += 1
+        if self.drop_rate and random.random() < self.drop_rate:
+            self.counters['丢弃'] += 1
+            return
+        rcode = dns.rcode.NOERROR
+        if self.servfail_rate and random.random() < self.servfail_rate:
+            self.counters['SERVFAIL'] += 1
+            rcode = dns.rcode.SERVFAIL
+        response = build_response(query, rcode, self.ttl)
+        if response is None:
+            return
+        delay = self.delay()
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, send, response)
+        else:
+            send(response)
+
+    async def start(self, host='127.0.0.1', port=0):
+        """在host上启动UDP和TCP监听（两者使用同一端口），返回实际端口"""
+        loop = asyncio.get_running_loop()
+        responder = self
+
+        class UDPProtocol(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, addr):
+                responder.respond(data, lambda response: self.transport.sendto(response, addr))
+
+        transport, _ = await loop.create_datagram_endpoint(UDPProtocol, local_addr=(host, port))
+        port = transport.get_extra_info('sockname')[1]
+
+        async def handle_tcp(reader, writer):
+            def send(response):
+                if not writer.is_closing():
+                    writer.write(struct.pack('!H', len(response)) + response)
+            try:
+                while True:
+                    length = int.from_bytes(await reader.readexactly(2), 'big')
+                    responder.respond(await reader.readexactly(length), send)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        try:
+            tcp_server = await asyncio.start_server(handle_tcp, host, port)
+        except OSError:
+            transport.close()
+            raise
+        self.servers = [transport, tcp_server]
+        return port
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+
+
+SERVE_DEFAULT_PORT = 5300  # 避开mDNS使用的5353端口（常被avahi等服务占用）
+
+
+def serve_main(argv):
+    """serve子命令：在本机运行DNS应答器，用于校准和离线基准测试"""
+    parser = argparse.ArgumentParser(
+        prog='dns-delay-testing.py serve',
+        description='在本机运行一个快速的DNS应答器（UDP和TCP），可配置人为延迟、丢包率和SERVFAIL比例'
+    )
+    parser.add_argument('--listen', default='127.0.0.1', help='监听地址（默认：127.0.0.1）')
+    parser.add_argument('--port', type=int, default=SERVE_DEFAULT_PORT,
+                        help=f'监听端口，UDP和TCP相同（默认：{SERVE_DEFAULT_PORT}，0表示随机端口）')
+    parser.add_argument('--delay', default='0',
+                        help='应答延迟分布（毫秒）：固定值如2，或fixed:2、uniform:1,5、exp:2、normal:5,1（默认：0）')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='丢弃查询（不应答）的比例，0-1（默认：0）')
+    parser.add_argument('--servfail-rate', type=float, default=0.0, help='返回SERVFAIL的比例，0-1（默认：0）')
+    parser.add_argument('--ttl', type=int, default=60, help='应答记录的TTL（默认：60）')
+    args = parser.parse_args(argv)
+    try:
+        delay = parse_delay_spec(args.delay)
+    except ValueError as e:
+        parser.error(str(e))
+    for name in ('drop_rate', 'servfail_rate'):
+        if not 0 <= getattr(args, name) <= 1:
+            parser.error(f"--{name.replace('_', '-')}必须在0到1之间")
+    if not 0 <= args.port <= 65535:
+        parser.error('--port必须在0到65535之间')
+    if not 0 <= args.ttl < 2**31:
+        parser.error('--ttl必须在0到2147483647之间')
+
+    responder = Responder(delay, args.drop_rate, args.servfail_rate, args.ttl)
+
+    async def run():
+        port = await responder.start(args.listen, args.port)
+        print(f"DNS应答器已启动: {args.listen}:{port}（UDP/TCP），延迟: {args.delay} ms，"
+              f"丢包率: {args.drop_rate}，SERVFAIL比例: {args.servfail_rate}")
+        print("按Ctrl+C停止")
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        # 端口被占用、地址不可用等
+        parser.error(f"无法在{args.listen}:{args.port}上监听: {e}")
+    print(", ".join(f"{name}: {count}" for name, count in responder.counters.items()))
+
+def percentile_confidence_interval(histogram, percent, z=1.96):
+    """基于次序统计量的百分位数置信区间（不依赖分布假设），返回(下限, 估计值, 上限)（微秒）"""
+    p = percent / 100
+    half_width = z * math.sqrt(p * (1 - p) / histogram.total_count) if histogram.total_count else 0.5
+    low = max(p - half_width, 0.0) * 100
+    high = min(p + half_width, 1.0) * 100
+    low_value, value, high_value = histogram.percentiles((low, percent, high))
+    return low_value, value, high_value
+
+
+ADAPTIVE_MIN_SAMPLES = 30  # 成功样本少于该数时不判断置信区间
+ADAPTIVE_CHECK_INTERVAL = 0.1  # 两次判断置信区间之间的最短间隔（秒）
+
+def parse_ci_threshold(text):
+    """解析置信区间目标：'0.5'表示半宽不超过0.5 ms，'2%'表示半宽不超过估计值的2%，返回(阈值, 是否相对值)"""
+    relative = text.endswith('%')
+    value = float(text[:-1] if relative else text)
+    if value <= 0:
+        raise ValueError('必须大于0')
+    return (value / 100 if relative else value * 1000), relative
+
+
+class AdaptiveStop:
+    """自适应采样的停止条件：所有目标的百分位数置信区间都足够窄，或达到最长测试时间"""
+
+    def __init__(self, targets, threshold, relative, percent=50, max_duration=None):
+        self.targets = targets
+        self.threshold = threshold  # 绝对值（微秒）或相对估计值的比例
+        self.relative = relative
+        self.percent = percent
+        self.max_duration = max_duration
+        self.reason = None
+        self.started_at = time.monotonic()
+        self.checked_at = 0.0
+
+    def converged(self, target):
+        histogram = target.stats.histogram
+        if histogram.total_count < ADAPTIVE_MIN_SAMPLES:
+            return False
+        low, value, high = percentile_confidence_interval(histogram, self.percent)
+        limit = self.threshold * value if self.relative else self.threshold
+        return (high - low) / 2 <= limit
+
+    def __call__(self):
+        if self.reason:
+            return True
+        now = time.monotonic()
+        if self.max_duration and now - self.started_at >= self.max_duration:
+            self.reason = '达到最长测试时间'
+            return True
+        # 计算分位数需要遍历直方图，限制判断频率
+        if now - self.checked_at < ADAPTIVE_CHECK_INTERVAL:
+            return False
+        self.checked_at = now
+        if all(self.converged(target) for target in self.targets):
+            self.reason = '置信区间达到目标'
+            return True
+        return False
+
+
+def print_confidence_interval(stats, percent):
+    """输出百分位数的95%置信区间"""
+    if not stats.histogram.total_count:
+        return
+    low, value, high = percentile_confidence_interval(stats.histogram, percent)
+    print(f"p{percent:g} 95%置信区间: {value / 1000:.2f} ms [{low / 1000:.2f}, {high / 1000:.2f}]，"
+          f"半宽 {(high - low) / 2000:.3f} ms")
+
+
+def start_responder_thread(**options):
+    """在独立线程的事件循环中启动内置应答器，避免与被测客户端争用同一事件循环，返回端口；
+    启动失败时在调用方重新抛出线程中的异常"""
+    started = threading.Event()
+    result = {}
+
+    def run():
+        async def serve():
+            result['port'] = await Responder(**options).start('127.0.0.1', 0)
+            started.set()
+            await asyncio.Event().wait()
+        try:
+            asyncio.run(serve())
+        except BaseException as e:
+            result['error'] = e
+        finally:
+            started.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    if 'port' not in result:
+        raise result['error']
+    return result['port']
+
+
+def run_calibration(args, channel_factory, count):
+    """用与正式测试相同的引擎和传输方式查询本机零延迟应答器，测得客户端自身开销，返回ProbeStats"""
+    port = start_responder_thread()
+    target = ProbeTarget(f"127.0.0.1:{port}", args.timeout, 0, args.significant_digits, check_port=False)
+    queries = zip(itertools.repeat('calibration.test'), itertools.repeat('A'))
+    if args.engine == 'async' or args.qps:
+        # 单并发测量，得到不含排队的开销下限
+        asyncio.run(run_async_engine([target], queries, count, args.timeout, 1, channel_factory))
+    else:
+        for domain, rdtype in itertools.islice(queries, count):
+            try:
+                target.record(rdtype, True, _resolver_query(
+                    target.endpoint.ip, target.endpoint.port, domain, rdtype, args.timeout))
+            except Exception as e:
+                target.record(rdtype, False, QueryFailure(type(e).__name__, e, _exception_rcode(e)))
+    return target.stats
+
+
+def print_overhead_adjusted(stats, overhead_us):
+    """输出扣除客户端开销基线后的延迟"""
+    histogram = stats.histogram
+    if not histogram.total_count:
+        return
+    p50, p99 = histogram.percentiles((50, 99))
+    print(f"扣除客户端开销后: 平均 {max(histogram.mean - overhead_us, 0) / 1000:.3f} ms, "
+          f"p50={max(p50 - overhead_us, 0) / 1000:.3f} ms, p99={max(p99 - overhead_us, 0) / 1000:.3f} ms")
+
+
+def build_queries(args, qtype_mix=None, shard=0, shards=1):
+    """按命令行参数生成(域名, 记录类型)查询序列；多进程时sequential方式按行分片，其余方式各进程独立抽样"""
+    if args.domains_file:
+        domains = DOMAIN_ORDERS[args.domain_order](args.domains_file, **(
+            {'buffer_size': args.shuffle_buffer} if args.domain_order == 'shuffle' else
+            {'exponent': args.zipf_exponent} if args.domain_order == 'zipf' else {}))
+        if args.domain_order == 'sequential' and shards > 1:
+            domains = itertools.islice(domains, shard, None, shards)
+    else:
+        domains = itertools.repeat(args.domain)
+    qtypes = iter_qtypes(qtype_mix) if qtype_mix else itertools.repeat('A')
+    return zip(domains, qtypes)
+
+
+def make_channel_factory(args):
+    return partial(CHANNELS[args.transport], connections=args.connections, tls_ca=args.tls_ca,
+                   tls_insecure=args.tls_insecure, tls_hostname=args.tls_hostname)
+
+
+def probe_worker(args, dns_servers, qtype_mix, shard, count, result_queue):
+    """工作进程：对查询序列的一个分片运行测试引擎，把紧凑的统计结果发回父进程"""
+    try:
+        # 端口连接性由父进程负责探测和展示，工作进程不再启动后台刷新
+        targets = [ProbeTarget(dns_server, args.timeout, 0, args.significant_digits,
+                               CHANNELS[args.transport].default_port, check_port=False)
+                   for dns_server in dns_servers]
+        # 主进程已清空结果文件，各进程以追加方式按批写入
+        sample_writers = open_sample_writers(args, dns_servers, append=True)
+        for target in targets:
+            target.sample_writers = sample_writers
+        queries = build_queries(args, qtype_mix, shard, args.workers)
+        if args.qps:
+            send_stats = asyncio.run(run_open_loop_engine(
+                targets, queries, count, args.timeout, args.qps / args.workers, make_channel_factory(args)))
+        else:
+            send_stats = None
+            concurrency = max(args.concurrency // args.workers, 1)
+            asyncio.run(run_async_engine(
+                targets, queries, count, args.timeout, concurrency, make_channel_factory(args)))
+        for writer in sample_writers:
+            writer.close()
+        result_queue.put((shard, {'targets': [target.to_dict() for target in targets], 'send_stats': send_stats}))
+    except Exception:
+        result_queue.put((shard, traceback.format_exc()))
+
+
+def run_workers(args, targets, qtype_mix):
+    """把测试次数分给args.workers个进程并行执行，汇总各进程发回的统计结果，返回合并后的发送情况统计"""
+    # 父进程已有后台线程，使用spawn避免fork多线程进程带来的死锁风险
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    processes = {}
+    for shard in range(args.workers):
+        count = args.count // args.workers + (1 if shard < args.count % args.workers else 0)
+        if count:
+            processes[shard] = context.Process(
+                target=probe_worker, daemon=True,
+                args=(args, [target.name for target in targets], qtype_mix, shard, count, result_queue))
+            processes[shard].start()
+
+    all_send_stats = []
+    pending = set(processes)
+    while pending:
+        try:
+            shard, result = result_queue.get(timeout=1)
+        except queue.Empty:
+            if any(processes[shard].is_alive() for shard in pending):
+                continue
+            print(f"工作进程异常退出，缺少其结果: {', '.join(str(shard) for shard in sorted(pending))}")
+            break
+        pending.discard(shard)
+        if isinstance(result, str):
+            print(f"工作进程{shard}测试失败:\n{result}")
+            continue
+        for target, data in zip(targets, result['targets']):
+            target.merge_dict(data)
+        if result['send_stats']:
+            all_send_stats.append(result['send_stats'])
+    for process in processes.values():
+        process.join()
+
+    if not all_send_stats:
+        return None
+    # 各进程并行发送，速率相加
+    return {
+        'achieved_qps': sum(stats['achieved_qps'] for stats in all_send_stats),
+        'late_count': sum(stats['late_count'] for stats in all_send_stats),
+        'max_lateness': max(stats['max_lateness'] for stats in all_send_stats),
+        'exhausted_count': sum(stats['exhausted_count'] for stats in all_send_stats),
+    }
+
+
+SUBCOMMANDS = {
+    'merge': merge_main,
+    'summary': summary_main,
+    'report': report_main,
+    'serve': serve_main,
+}
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+
     # 解析命令行参数
     parser = argparse.ArgumentParser(
         description='DNS延迟测试工具',
@@ -95,57 +2443,313 @@ def main():
   python "dns delay testing.py" --dns 8.8.8.8
   python "dns delay testing.py" --dns 8.8.8.8:53 --domain google.com
   python "dns delay testing.py" --dns 43.133.224.74:532 --count 10 --timeout 3
+  python "dns delay testing.py" --dns 8.8.8.8 --engine async --concurrency 100 --count 10000
+  python "dns delay testing.py" --dns 8.8.8.8 --engine threads --threads 16 --count 1000
+  python "dns delay testing.py" --dns 10.0.0.53 --qps 2000 --count 60000
+  python "dns delay testing.py" --dns 8.8.8.8 --dns 1.1.1.1 --dns 223.5.5.5 --engine async --count 1000
+  python "dns delay testing.py" --dns 10.0.0.53 --domains-file top-1m.csv --domain-order zipf --engine async --count 100000
+  python "dns delay testing.py" --dns 8.8.8.8 --qtype-mix A=70,AAAA=20,MX=5,TXT=5 --engine async --count 10000
+  python "dns delay testing.py" --dns 8.8.8.8 --transport tcp --connections 8 --engine async --count 10000
+  python "dns delay testing.py" --dns dns.google --transport dot --engine async --count 10000
+  python "dns delay testing.py" --dns https://dns.google/dns-query --transport doh --connections 1 --concurrency 100 --engine async --count 10000
+  python "dns delay testing.py" --dns 8.8.8.8 --engine async --target-ci 2% --max-duration 60
+  python "dns delay testing.py" --dns 10.0.0.53 --qps 100000 --workers 8 --count 6000000
+  python "dns delay testing.py" --dns 8.8.8.8 --engine async --count 1000000 --output jsonl --output-file samples.jsonl
+  python "dns delay testing.py" --dns 8.8.8.8 --engine async --count 1000000 --output binary --output-file samples.bin
+  python "dns delay testing.py" --dns 8.8.8.8 --dns 1.1.1.1 --engine async --count 10000 --store sqlite:results.db
+  python "dns delay testing.py" merge site-a.json site-b.json
+  python "dns delay testing.py" summary samples.bin
+  python "dns delay testing.py" report results.db --since 2024-01-01
+  python "dns delay testing.py" serve --port 5300 --delay exp:2 --drop-rate 0.01
 """
     )
-    parser.add_argument('--dns', required=True, help='DNS服务器（支持IP地址或域名，格式如：8.8.8.8 或 8.8.8.8:532 或 dns.example.com）')
+    parser.add_argument('--dns', action='append', help='DNS服务器（支持IP地址或域名，格式如：8.8.8.8 或 8.8.8.8:532 或 dns.example.com），可重复指定多个')
+    parser.add_argument('--dns-file', action='append', help='DNS服务器列表文件，每行一个服务器，可重复指定')
     parser.add_argument('--domain', default='baidu.com', help='测试域名（默认：baidu.com）')
+    parser.add_argument('--domains-file', help='域名列表文件（每行一个域名，或"排名,域名"格式的CSV），流式读取')
+    parser.add_argument('--domain-order', choices=sorted(DOMAIN_ORDERS), default='sequential',
+                        help='域名列表的抽样方式：sequential顺序、shuffle流式乱序、zipf按热度加权（默认：sequential）')
+    parser.add_argument('--shuffle-buffer', type=int, default=10000, help='shuffle方式的乱序缓冲区大小（默认：10000）')
+    parser.add_argument('--zipf-exponent', type=float, default=1.0, help='zipf方式的分布指数（默认：1.0）')
+    parser.add_argument('--qtype-mix', help='查询类型及权重，每次查询按权重抽样，如：A=70,AAAA=20,MX=5,TXT=5（默认只查询A记录）')
     parser.add_argument('--count', type=int, default=5, help='测试次数（默认：5）')
+    parser.add_argument('--target-ci',
+                        help='自适应采样：持续测试直到百分位数的95%%置信区间半宽不超过该值，'
+                             '如0.5（毫秒）或2%%（相对估计值），此时--count不再生效')
+    parser.add_argument('--ci-percentile', type=float, default=50, help='自适应采样判断的百分位数（默认：50，即中位数）')
+    parser.add_argument('--max-count', type=int, help='自适应采样的最大测试次数（默认：10000）')
+    parser.add_argument('--max-duration', type=float, help='自适应采样的最长测试时间（秒，默认不限制）')
     parser.add_argument('--timeout', type=int, default=5, help='超时时间（秒，默认：5）')
+    parser.add_argument('--engine', choices=['serial', 'async', 'threads'], default='serial',
+                        help='测试引擎：serial为逐次测试，async为异步并发测试，'
+                             'threads为线程池并发执行与serial相同的查询（默认：serial）')
+    parser.add_argument('--threads', type=int, default=8, help='threads引擎的线程数（默认：8）')
+    parser.add_argument('--concurrency', type=int, default=50, help='async引擎同时在途的查询数（默认：50）')
+    parser.add_argument('--transport', choices=sorted(CHANNELS), default='udp',
+                        help='查询传输方式：udp、tcp长连接流水线、dot（DNS-over-TLS，默认端口853）或'
+                             'doh（DNS-over-HTTPS/HTTP2，默认端口443，--dns可使用URL，需安装h2），'
+                             'tcp/dot/doh需配合--engine async或--qps（默认：udp）')
+    parser.add_argument('--connections', type=int, default=4,
+                        help='tcp/dot/doh方式每个服务器保持的长连接数，udp方式为每个服务器轮流使用的套接字数（默认：4）')
+    parser.add_argument('--tls-ca', help='dot/doh方式信任的CA证书文件（可用于本地自签名证书）')
+    parser.add_argument('--tls-insecure', action='store_true', help='dot/doh方式跳过证书校验')
+    parser.add_argument('--tls-hostname', help='dot/doh方式用于SNI和证书校验的主机名（默认：--dns中的主机部分）')
+    parser.add_argument('--phases', action='store_true',
+                        help='逐阶段计时（地址解析、报文构建、套接字连接、发送、首字节、解析），仅支持serial引擎')
+    parser.add_argument('--kernel-timestamps', action='store_true',
+                        help='使用SO_TIMESTAMPNS内核接收时间戳计算延迟，并与用户态计时对比（仅Linux，仅支持serial引擎）')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='先用相同的引擎和传输方式查询本机内置应答器，测量客户端自身开销并在汇总中扣除')
+    parser.add_argument('--calibrate-count', type=int, default=1000, help='校准查询次数（默认：1000）')
+    parser.add_argument('--qps', type=float, help='开环模式：按固定速率发送查询，不等待响应（基于async引擎）')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='工作进程数：把测试次数、--concurrency和--qps平均分给多个进程并行执行，'
+                             '需配合--engine async或--qps使用（默认：1）')
+    parser.add_argument('--significant-digits', type=int, choices=range(1, 6), default=3,
+                        help='延迟直方图的有效数字位数（1-5，默认：3）')
+    parser.add_argument('--output', choices=['text', 'jsonl', 'binary'], default='text',
+                        help='样本输出格式：text只输出文字结果，jsonl额外把每个样本写成一行JSON，'
+                             'binary额外写入紧凑的二进制列式文件（可用summary子命令读取）（默认：text）')
+    parser.add_argument('--output-file',
+                        help='样本输出文件（jsonl默认为-，即标准输出，此时文字结果改为输出到标准错误；binary必须指定文件）')
+    parser.add_argument('--store', help='把本次运行和每个样本写入结果库，格式为sqlite:文件路径（可用report子命令查询）')
+    parser.add_argument('--save-result', help='把测试结果保存为可合并的结果文件（供merge子命令使用，多个服务器时按服务器分别保存）')
+    parser.add_argument('--probe-interval', type=float, default=30,
+                        help='后台刷新端口连接性的间隔（秒，0表示只在启动时探测一次，默认：30）')
+    parser.add_argument('--report-setup-cost', action='store_true',
+                        help='报告每次测试的Resolver准备开销（新建与复用对比）')
     args = parser.parse_args()
+    if args.qps is not None and args.qps <= 0:
+        parser.error('--qps必须大于0')
+    if args.transport != 'udp' and args.engine != 'async' and not args.qps:
+        parser.error(f'--transport {args.transport}需要配合--engine async或--qps使用')
+    if args.transport == 'doh' and h2 is None:
+        parser.error('doh传输方式需要安装h2：pip install h2')
+    if args.phases and (args.engine != 'serial' or args.qps or args.transport != 'udp'):
+        parser.error('--phases仅支持serial引擎和udp传输方式')
+    if args.kernel_timestamps:
+        if not sys.platform.startswith('linux'):
+            parser.error('--kernel-timestamps仅支持Linux')
+        if args.phases or args.engine != 'serial' or args.qps or args.transport != 'udp':
+            parser.error('--kernel-timestamps仅支持serial引擎和udp传输方式，且不能与--phases同时使用')
+    if args.calibrate and args.transport not in ('udp', 'tcp'):
+        parser.error('--calibrate仅支持udp和tcp传输方式（内置应答器不提供TLS）')
+    if args.connections < 1:
+        parser.error('--connections必须大于0')
+    if args.concurrency < 1:
+        parser.error('--concurrency必须大于0')
+    if args.target_ci:
+        try:
+            ci_threshold, ci_relative = parse_ci_threshold(args.target_ci)
+        except ValueError as e:
+            parser.error(f"--target-ci格式错误: {e}")
+        if not 0 < args.ci_percentile < 100:
+            parser.error('--ci-percentile必须在0到100之间')
+        if args.max_count is None:
+            args.max_count = 10000
+        if args.max_count < 1:
+            parser.error('--max-count必须大于0')
+        if args.max_duration is not None and args.max_duration <= 0:
+            parser.error('--max-duration必须大于0')
+        # 达到目标精度或上限前持续测试，测试次数以--max-count为上限
+        args.count = args.max_count
+    elif args.max_count is not None or args.max_duration is not None:
+        parser.error('--max-count和--max-duration需要配合--target-ci使用')
+    if args.workers < 1:
+        parser.error('--workers必须大于0')
+    if args.threads < 1:
+        parser.error('--threads必须大于0')
+    if args.output == 'jsonl':
+        args.output_file = args.output_file or '-'
+        if args.output_file == '-' and args.workers > 1:
+            parser.error('--workers大于1时jsonl样本需要通过--output-file写入文件')
+    elif args.output == 'binary':
+        if not args.output_file or args.output_file == '-':
+            parser.error('--output binary需要通过--output-file指定文件')
+    elif args.output_file:
+        parser.error('--output-file需要配合--output jsonl或binary使用')
+    if args.store:
+        scheme, _, args.store_path = args.store.partition(':')
+        if scheme != 'sqlite' or not args.store_path:
+            parser.error('--store格式应为sqlite:文件路径')
+    if args.workers > 1:
+        if args.engine != 'async' and not args.qps:
+            parser.error('--workers需要配合--engine async或--qps使用')
+        if args.target_ci:
+            parser.error('--workers不能与--target-ci同时使用')
+    if args.tls_ca:
+        try:
+            create_tls_context(args.tls_ca)
+        except (OSError, ssl.SSLError) as e:
+            parser.error(f"无法加载CA证书文件 {args.tls_ca}: {e}")
+
+    dns_servers = list(args.dns or [])
+    for path in args.dns_file or []:
+        try:
+            dns_servers.extend(read_dns_file(path))
+        except OSError as e:
+            parser.error(f"无法读取DNS服务器列表文件 {path}: {e}")
+    if not dns_servers:
+        parser.error('至少需要通过--dns或--dns-file指定一个DNS服务器')
+    qtype_mix = None
+    if args.qtype_mix:
+        try:
+            qtype_mix = parse_qtype_mix(args.qtype_mix)
+        except ValueError as e:
+            parser.error(f"--qtype-mix格式错误: {e}")
+    if args.domains_file:
+        try:
+            with open(args.domains_file, encoding='utf-8', errors='replace') as f:
+                # 读到第一个有效域名即停止，不扫描整个文件
+                has_domain = any(_parse_domain_line(line) for line in f)
+        except OSError as e:
+            parser.error(f"无法读取域名列表文件 {args.domains_file}: {e}")
+        if not has_domain:
+            parser.error(f"域名列表文件中没有可用的域名: {args.domains_file}")
+
+    try:
+        if args.store:
+            args.store_run_id = create_store_run(args.store_path, 'async（开环）' if args.qps else args.engine,
+                                                 args.transport, ' '.join(sys.argv[1:]))
+        sample_writers = open_sample_writers(args, dns_servers)
+    except OSError as e:
+        parser.error(f"无法写入样本输出文件 {args.output_file}: {e}")
+    except sqlite3.Error as e:
+        parser.error(f"无法打开结果库 {args.store_path}: {e}")
+    if args.output == 'jsonl' and args.output_file == '-':
+        # 标准输出留给jsonl样本，文字结果改为输出到标准错误
+        sys.stdout = sys.stderr
 
     print(f"=== DNS延迟测试开始 ===")
-    print(f"DNS服务器: {args.dns}")
-    print(f"测试域名: {args.domain}")
-    print(f"测试次数: {args.count}")
+    print(f"DNS服务器: {', '.join(dns_servers)}")
+    if args.domains_file:
+        print(f"测试域名: {args.domains_file}（{args.domain_order}）")
+    else:
+        print(f"测试域名: {args.domain}")
+    if qtype_mix:
+        print(f"查询类型: {', '.join(f'{rdtype}={weight:g}' for rdtype, weight in qtype_mix.items())}")
+    if args.target_ci:
+        print(f"测试次数: 自适应（p{args.ci_percentile:g}置信区间半宽不超过{args.target_ci}"
+              f"{'' if ci_relative else ' ms'}，最多{args.max_count}次"
+              f"{f'/{args.max_duration:g}秒' if args.max_duration else ''}）")
+    else:
+        print(f"测试次数: {args.count}")
     print(f"超时时间: {args.timeout}秒")
+    print(f"测试引擎: {'async（开环）' if args.qps else args.engine}")
+    print(f"传输方式: {args.transport}")
+    if args.workers > 1:
+        print(f"工作进程数: {args.workers}")
     print(f"开始时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("-" * 50)
 
-    results = []
-    success_count = 0
-    latency_list = []
-
-    for i in range(args.count):
-        print(f"第{i+1}次测试...", end=' ')
-        success, result = test_dns_latency(
-            dns_server=args.dns,
-            domain=args.domain,
-            timeout=args.timeout
-        )
-        
-        if success:
-            success_count += 1
-            latency_list.append(result)
-            print(f"成功，延迟: {result:.2f} ms")
+    channel_factory = make_channel_factory(args)
+    targets = [ProbeTarget(dns_server, args.timeout, args.probe_interval, args.significant_digits,
+                           CHANNELS[args.transport].default_port)
+               for dns_server in dns_servers]
+    for target in targets:
+        target.sample_writers = sample_writers
+        target.health.start()
+        label = f"[{target.name}] " if len(targets) > 1 else ""
+        print(f"{label}服务器IP: {target.endpoint.ip}, 端口: {target.endpoint.port}, "
+              f"端口连接状态: {'开放' if target.health.port_open else '关闭或无法连接'}")
+
+    overhead = None
+    if args.calibrate:
+        try:
+            calibration = run_calibration(args, channel_factory, args.calibrate_count)
+        except OSError as e:
+            # 本机应答器无法启动等，不扣除开销继续正式测试
+            print(f"客户端开销校准失败: {type(e).__name__}: {e}")
         else:
-            print(f"失败，原因: {result}")
-        
-        results.append((success, result))
-        # 测试间隔（避免请求过于密集）
-        if i < args.count - 1:
-            time.sleep(0.5)
+            if calibration.histogram.total_count:
+                low, overhead, high = percentile_confidence_interval(calibration.histogram, 50)
+                print(f"客户端开销基线（本机应答器，{calibration.success_count}次）: 中位 {overhead / 1000:.3f} ms，"
+                      f"95%置信区间 [{low / 1000:.3f}, {high / 1000:.3f}] ms，最小 {calibration.histogram.min_value / 1000:.3f} ms")
+            else:
+                print("客户端开销校准失败：本机应答器没有成功应答")
 
-    print("-" * 50)
-    print(f"=== 测试结果汇总 ===")
-    print(f"总测试次数: {args.count}")
-    print(f"成功次数: {success_count}")
-    print(f"失败次数: {args.count - success_count}")
-    print(f"成功率: {success_count/args.count*100:.2f}%")
+    # 自适应采样从正式测试开始计时（不含校准）
+    stop = AdaptiveStop(targets, ci_threshold, ci_relative, args.ci_percentile, args.max_duration) \
+        if args.target_ci else None
+
+    send_stats = thread_stats = None
+    if args.qps:
+        print(f"目标QPS: {args.qps:g}（每个服务器）")
+    if args.workers > 1:
+        if args.engine == 'async' and not args.qps:
+            print(f"并发数: {args.concurrency}（共{args.workers}个进程）")
+        send_stats = run_workers(args, targets, qtype_mix)
+    elif args.qps:
+        send_stats = asyncio.run(run_open_loop_engine(
+            targets=targets,
+            queries=build_queries(args, qtype_mix),
+            count=args.count,
+            timeout=args.timeout,
+            qps=args.qps,
+            channel_factory=channel_factory,
+            stop=stop
+        ))
+    elif args.engine == 'async':
+        print(f"并发数: {args.concurrency}")
+        asyncio.run(run_async_engine(
+            targets=targets,
+            queries=build_queries(args, qtype_mix),
+            count=args.count,
+            timeout=args.timeout,
+            concurrency=args.concurrency,
+            channel_factory=channel_factory,
+            stop=stop
+        ))
+    elif args.engine == 'threads':
+        thread_stats = run_thread_engine(targets, build_queries(args, qtype_mix), args.count, args.timeout,
+                                         args.threads, stop)
+    else:
+        run_serial_engine(targets, build_queries(args, qtype_mix), args.count, args.timeout,
+                          args.phases, args.kernel_timestamps, stop)
+    for target in targets:
+        target.health.stop()
+    for writer in sample_writers:
+        writer.close()
+    if args.store:
+        finish_store_run(args.store_path, args.store_run_id)
+        print(f"样本已写入结果库: {args.store_path}（运行编号 {args.store_run_id}）")
+    if send_stats:
+        print_send_stats(send_stats)
+    if thread_stats:
+        print_thread_stats(thread_stats)
+    if stop is not None:
+        print(f"自适应采样结束: {stop.reason or '达到最大测试次数'}，"
+              f"用时 {time.monotonic() - stop.started_at:.1f} 秒")
+
+    for target in targets:
+        print_summary(target.stats, target.name if len(targets) > 1 else None)
+        if len(target.type_stats) > 1:
+            print_type_breakdown(target)
+        if overhead is not None:
+            print_overhead_adjusted(target.stats, overhead)
+        if stop is not None:
+            print_confidence_interval(target.stats, args.ci_percentile)
+        if target.setup_stats:
+            print_setup_stats(target)
+        if target.phase_stats:
+            print_phase_stats(target)
+        for name, value in target.transport_info.items():
+            print(f"{name}: {value}")
+        if args.qps:
+            print_comparison('原始 / 协调遗漏校正', target.stats, target.corrected_stats)
+        if args.kernel_timestamps:
+            print_comparison('用户态 / 内核接收时间戳', target.stats, target.kernel_stats)
+    if len(targets) > 1:
+        print_ranking([(target.name, target.stats) for target in targets])
+
+    if args.save_result:
+        save_results(args.save_result, {target.name: target.stats for target in targets})
+        print(f"测试结果已保存到: {args.save_result}")
 
-    if latency_list:
-        print(f"最小延迟: {min(latency_list):.2f} ms")
-        print(f"最大延迟: {max(latency_list):.2f} ms")
-        print(f"平均延迟: {sum(latency_list)/len(latency_list):.2f} ms")
+    if args.report_setup_cost:
+        fresh_cost, pooled_cost = measure_setup_cost(targets[0].endpoint, args.timeout)
+        print(f"单次准备开销（每次新建Resolver）: {fresh_cost:.2f} us")
+        print(f"单次准备开销（复用Resolver池）: {pooled_cost:.2f} us")
 
     print(f"结束时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
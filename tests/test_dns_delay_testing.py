@@ -0,0 +1,210 @@
+import contextlib
+import importlib.util
+import io
+import os
+import random
+import tempfile
+import unittest
+
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+
+# 脚本文件名包含连字符，不能直接import
+_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dns-delay-testing.py')
+_spec = importlib.util.spec_from_file_location('dns_delay_testing', _SCRIPT)
+ddt = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(ddt)
+
+
+def exact_percentile(values, percent):
+    """与LatencyHistogram.percentiles相同的定义：第ceil(n*p/100)小的值"""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def test_percentiles_within_relative_error(self):
+        rng = random.Random(1)
+        for digits in (1, 2, 3):
+            histogram = ddt.LatencyHistogram(digits)
+            # 对数均匀分布，覆盖1微秒到约17分钟
+            values = [int(10 ** rng.uniform(0, 9)) for _ in range(5000)]
+            for value in values:
+                histogram.record(value)
+            percents = (1, 10, 50, 90, 99, 99.9, 100)
+            for percent, value in zip(percents, histogram.percentiles(percents)):
+                expected = exact_percentile(values, percent)
+                self.assertGreaterEqual(value, expected)
+                self.assertLessEqual(value - expected, expected * 10 ** -digits, (digits, percent))
+
+    def test_small_values_are_exact(self):
+        histogram = ddt.LatencyHistogram()
+        for value in range(1, 1001):
+            histogram.record(value)
+        self.assertEqual(histogram.percentiles((50, 99, 100)), [500, 990, 1000])
+        self.assertEqual((histogram.min_value, histogram.max_value), (1, 1000))
+        self.assertEqual(histogram.mean, 500.5)
+
+    def test_values_above_highest_are_clamped(self):
+        histogram = ddt.LatencyHistogram(highest_value=10**6)
+        histogram.record(10**9)
+        self.assertEqual(histogram.max_value, 10**6)
+        self.assertEqual(histogram.percentiles((100,)), [10**6])
+
+    def test_merge_matches_recording_everything_in_one(self):
+        rng = random.Random(2)
+        first, second, combined = (ddt.LatencyHistogram() for _ in range(3))
+        for histogram in (first, second):
+            for _ in range(2000):
+                value = rng.randrange(1, 10**7)
+                histogram.record(value)
+                combined.record(value)
+        first.add(second)
+        self.assertEqual(first.counts, combined.counts)
+        self.assertEqual((first.total_count, first.value_sum, first.min_value, first.max_value),
+                         (combined.total_count, combined.value_sum, combined.min_value, combined.max_value))
+
+    def test_merge_with_different_precision(self):
+        coarse, fine = ddt.LatencyHistogram(1), ddt.LatencyHistogram(3)
+        for value in (100, 2000, 30000):
+            fine.record(value)
+        coarse.add(fine)
+        self.assertEqual(coarse.total_count, 3)
+        for value, expected in zip(coarse.percentiles((33, 66, 100)), (100, 2000, 30000)):
+            self.assertLessEqual(abs(value - expected), expected * 0.1)
+
+    def test_dict_round_trip(self):
+        histogram = ddt.LatencyHistogram()
+        for value in (5, 50, 500, 5000, 5000):
+            histogram.record(value)
+        restored = ddt.LatencyHistogram.from_dict(histogram.to_dict())
+        self.assertEqual(restored.counts, histogram.counts)
+        self.assertEqual(restored.percentiles((50, 99)), histogram.percentiles((50, 99)))
+        self.assertEqual((restored.min_value, restored.max_value, restored.value_sum),
+                         (5, 5000, histogram.value_sum))
+
+
+class BinarySamplesTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'samples.bin')
+
+    def write_samples(self):
+        writer = ddt.BinarySampleWriter.open(self.path, ['8.8.8.8', '1.1.1.1'])
+        writer.write('8.8.8.8', 'a.test', 'A', True, 1.5)
+        writer.write('8.8.8.8', 'a.test', 'A', False, ddt.QueryFailure('Timeout', '超时'))
+        writer.flush()  # 分成多个数据块
+        writer.write('1.1.1.1', 'a.test', 'A', True, 3.0)
+        writer.write('1.1.1.1', 'a.test', 'A', False, ddt.QueryFailure('NoNameservers', '失败', 'SERVFAIL'))
+        writer.close()
+        # 工作进程以追加方式写入同一文件
+        writer = ddt.BinarySampleWriter(open(self.path, 'ab'), ['8.8.8.8', '1.1.1.1'], close_stream=True)
+        writer.write('8.8.8.8', 'b.test', 'AAAA', True, 2.5)
+        writer.close()
+
+    def test_read_back(self):
+        self.write_samples()
+        names, stats, rcodes, (first_time, last_time) = ddt.read_binary_samples(self.path)
+        self.assertEqual(names, ['8.8.8.8', '1.1.1.1'])
+        self.assertEqual([(s.success_count, s.failure_count) for s in stats], [(2, 1), (1, 1)])
+        self.assertEqual((stats[0].histogram.min_value, stats[0].histogram.max_value), (1500, 2500))
+        self.assertEqual(stats[1].histogram.percentiles((50,)), [3000])
+        self.assertEqual(dict(rcodes[0]), {dns.rcode.NOERROR: 2, ddt.BINARY_NO_RESPONSE: 1})
+        self.assertEqual(dict(rcodes[1]), {dns.rcode.NOERROR: 1, dns.rcode.SERVFAIL: 1})
+        self.assertLessEqual(first_time, last_time)
+
+    def test_summary_output(self):
+        self.write_samples()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            ddt.summary_main([self.path])
+        text = output.getvalue()
+        self.assertIn('=== 测试结果汇总 [8.8.8.8] ===', text)
+        self.assertIn('响应码: NOERROR=2, 无响应=1', text)
+        self.assertIn('响应码: NOERROR=1, SERVFAIL=1', text)
+        self.assertIn('服务器对比', text)
+
+    def test_truncated_file_is_rejected(self):
+        self.write_samples()
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 20)
+        with self.assertRaises(ValueError):
+            ddt.read_binary_samples(self.path)
+
+
+class BuildResponseTest(unittest.TestCase):
+
+    def query(self, rdtype='A', **options):
+        return dns.message.make_query('example.com', rdtype, **options).to_wire()
+
+    def test_answers_a_query(self):
+        query = self.query()
+        response = dns.message.from_wire(ddt.build_response(query, ttl=30))
+        self.assertEqual(response.id, int.from_bytes(query[:2], 'big'))
+        self.assertEqual(response.rcode(), dns.rcode.NOERROR)
+        self.assertTrue(response.flags & dns.flags.QR and response.flags & dns.flags.RD)
+        self.assertEqual(str(response.question[0].name), 'example.com.')
+        answer, = response.answer
+        self.assertEqual((answer.rdtype, answer.ttl, str(answer[0])), (dns.rdatatype.A, 30, '127.0.0.1'))
+
+    def test_answers_each_supported_type(self):
+        for rdtype in ('AAAA', 'NS', 'CNAME', 'MX', 'TXT', 'HTTPS'):
+            response = dns.message.from_wire(ddt.build_response(self.query(rdtype)))
+            self.assertEqual(response.answer[0].rdtype, dns.rdatatype.from_text(rdtype), rdtype)
+
+    def test_error_rcode_and_unknown_type_have_no_answer(self):
+        response = dns.message.from_wire(ddt.build_response(self.query(), dns.rcode.SERVFAIL))
+        self.assertEqual((response.rcode(), response.answer), (dns.rcode.SERVFAIL, []))
+        response = dns.message.from_wire(ddt.build_response(self.query('SRV')))
+        self.assertEqual((response.rcode(), response.answer), (dns.rcode.NOERROR, []))
+
+    def test_edns_query(self):
+        response = dns.message.from_wire(ddt.build_response(self.query(use_edns=0)))
+        self.assertEqual(len(response.answer), 1)
+
+    def test_invalid_queries(self):
+        query = self.query()
+        self.assertIsNone(ddt.build_response(query[:11]))
+        self.assertIsNone(ddt.build_response(query[:2] + bytes([query[2] | 0x80]) + query[3:]))  # 已经是应答
+        self.assertIsNone(ddt.build_response(query[:-3]))  # 问题节不完整
+        self.assertIsNone(ddt.build_response(query[:12] + b'\xc0\x0c\x00\x01\x00\x01'))  # 问题节中的压缩指针
+
+
+class ParseQtypeMixTest(unittest.TestCase):
+
+    def test_weights(self):
+        self.assertEqual(ddt.parse_qtype_mix('A=70,aaaa=20, MX=5 ,TXT=5'),
+                         {'A': 70, 'AAAA': 20, 'MX': 5, 'TXT': 5})
+
+    def test_default_weight_and_duplicates(self):
+        self.assertEqual(ddt.parse_qtype_mix('A,AAAA=2,A=2'), {'A': 3.0, 'AAAA': 2.0})
+
+    def test_invalid(self):
+        for text in ('A=70,BOGUS=1', 'A=-1', 'A=0,AAAA=0', 'A=x'):
+            with self.assertRaises(ValueError, msg=text):
+                ddt.parse_qtype_mix(text)
+
+
+class ParseDelaySpecTest(unittest.TestCase):
+
+    def test_distributions(self):
+        self.assertEqual(ddt.parse_delay_spec('2')(), 0.002)
+        self.assertEqual(ddt.parse_delay_spec('fixed:0')(), 0.0)
+        self.assertTrue(0.001 <= ddt.parse_delay_spec('uniform:1,5')() <= 0.005)
+        self.assertGreaterEqual(ddt.parse_delay_spec('exp:2')(), 0.0)
+        self.assertGreaterEqual(ddt.parse_delay_spec('normal:1,5')(), 0.0)
+
+    def test_invalid(self):
+        for text in ('exp:-1', 'normal:2,-1', '-3', 'uniform:1', 'gamma:1', 'fixed:x'):
+            with self.assertRaises(ValueError, msg=text):
+                ddt.parse_delay_spec(text)
+
+
+if __name__ == '__main__':
+    unittest.main()